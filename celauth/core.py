@@ -1,6 +1,10 @@
 
+import hmac
 import os
-from base64 import b32encode
+import struct
+import time
+from base64 import b32encode, b32decode
+from hashlib import sha1
 from warnings import warn
 from celauth.session import CelSession
 
@@ -30,6 +34,10 @@ class AccountConflict(AuthError):
     def __init__(self):
         AuthError.__init__(self, "Logins to different accounts can not be joined")
 
+class TooManyConfirmationCodes(AuthError):
+    def __init__(self):
+        AuthError.__init__(self, "Too many email confirmation codes requested, try again later")
+
 def normalize_email(email):
     if email:
         try:
@@ -45,6 +53,13 @@ class CelLogin(object):
         self._store = registry_store
         self._loginid = loginid
         self._login = self._store.get_login(loginid)
+        self._answers = dict()
+
+    def _ask(self, question):
+        """Memoized answer of registry store question about this login's address"""
+        if question not in self._answers:
+            self._answers[question] = getattr(self._store, question)(self.address)
+        return self._answers[question]
 
     @property
     def account(self):
@@ -61,44 +76,176 @@ class CelLogin(object):
     def must_join_account(self):
         if self.account:
             return False
-        return self.address and not self._store.is_free_address(self.address)
+        return self.address and not self._ask('is_free_address')
 
     def confirmation_required(self):
         if self.address and not self.confirmed:
-            if self._store.assigned_account(self.address):
+            if self._ask('assigned_account'):
                 return True
         return False
 
     def can_create_account(self):
         if self.account:
             return False
-        return self.address and self._store.is_free_address(self.address)
+        return self.address and self._ask('is_free_address')
 
     def create_account(self):
         account = self._store.create_account(self._loginid)
         assert account
+        self._answers.clear()
         if self.address and self._store.is_free_address(self.address):
             self._store.assign(self.address, account)
 
+class TokenBuckets(object):
+    """Token bucket rate limits per key, with bucket state in a bucket store.
+
+    A bucket store has take(key, capacity, refill_seconds, now), atomically
+    taking a token from the bucket of key if it has one and returning whether
+    it did, and give(key, capacity, refill_seconds, now), returning a token
+    taken.
+    """
+
+    def __init__(self, bucket_store, capacity, refill_seconds):
+        self._store = bucket_store
+        self.capacity = capacity
+        self.refill_seconds = refill_seconds
+
+    def take(self, keys, now=None):
+        """Take a token from the bucket of every key, if all have one.
+        Returns whether tokens were taken.
+        """
+        if now is None:
+            now = time.time()
+        taken = []
+        for key in keys:
+            if not self._store.take(key, self.capacity, self.refill_seconds, now):
+                for k in taken:
+                    self._store.give(k, self.capacity, self.refill_seconds, now)
+                return False
+            taken.append(key)
+        return True
+
+class SignedCodes(object):
+    """Stateless confirmation codes signing the address and expiration time.
+
+    Codes are checked without the registry store. Each code is accepted once,
+    by remembering used codes in a replay set until they expire. A replay set
+    has add(code, expiration), returning whether code was not already added.
+    """
+
+    MAC_SIZE = 10
+
+    def __init__(self, secret, replay_set, lifetime=12*60*60):
+        if isinstance(secret, unicode):
+            secret = secret.encode('utf-8')
+        self._key = sha1('celauth.SignedCodes' + secret).digest()
+        self._replay_set = replay_set
+        self.lifetime = lifetime
+
+    def _mac(self, payload):
+        return hmac.new(self._key, payload, sha1).digest()[:self.MAC_SIZE]
+
+    def make(self, address, now=None):
+        if now is None:
+            now = time.time()
+        payload = struct.pack('>I', int(now + self.lifetime)) + address.encode('utf-8')
+        return b32encode(self._mac(payload) + payload).rstrip('=')
+
+    def _decode(self, code):
+        """(normalized code, expiration, address) if code is signed, otherwise None"""
+        try:
+            code = code.encode('ascii').upper()
+            raw = b32decode(code + '=' * (-len(code) % 8))
+        except (UnicodeError, TypeError):
+            return None
+        mac, payload = raw[:self.MAC_SIZE], raw[self.MAC_SIZE:]
+        if len(payload) < 4 or not hmac.compare_digest(mac, self._mac(payload)):
+            return None
+        expiration = struct.unpack('>I', payload[:4])[0]
+        return code, expiration, payload[4:].decode('utf-8')
+
+    def verify(self, code, now=None):
+        """Address of code if valid, used before or not, otherwise None"""
+        if now is None:
+            now = time.time()
+        decoded = self._decode(code)
+        if not decoded or decoded[1] < now:
+            return None
+        return decoded[2]
+
+    def use(self, code):
+        """Remember valid code as used, returning whether it was not used before"""
+        code, expiration, address = self._decode(code)
+        return self._replay_set.add(code, expiration)
+
+    def check(self, code, now=None):
+        """Address of code if valid and not used before, otherwise None"""
+        address = self.verify(code, now)
+        if not address or not self.use(code):
+            return None
+        return address
+
 class CelRegistry(object):
-    def __init__(self, registry_store, mailer):
+    # a code sent this recently and still valid is sent again, if the store has it,
+    # or else not replaced by a new one
+    code_reuse_seconds = 10 * 60
+
+    def __init__(self, registry_store, mailer, code_limiter=None, signed_codes=None):
         self._store = registry_store
         self._mailer = mailer
+        self._code_limiter = code_limiter
+        self._signed_codes = signed_codes
 
     def get_login(self, loginid):
         assert loginid
         return CelLogin(self._store, loginid)
 
-    def _equiv_loginids(self, loginid):
+    def login_key(self, loginid):
+        """Primitive value of loginid to keep in sessions"""
+        return self._store.login_key(loginid)
+
+    def login_by_key(self, key):
+        return self._store.login_by_key(key)
+
+    def atomic(self):
+        """Context manager making registry store writes within it all or nothing"""
+        return self._store.atomic()
+
+    def _equiv_logins(self, loginid):
+        """List of (loginid, address, confirmed) for all logins of the same account"""
         if not loginid:
             return []
         account = self._store.account(loginid)
-        return self._store.loginids(account) if account else [loginid]
+        if account:
+            return self._store.account_logins(account)
+        login = self.get_login(loginid)
+        return [(loginid, login.address, login.confirmed)]
 
-    def _send_code(self, address):
-        # os.urandom(5) will produce about 1 trillion possibilities
-        code = b32encode(os.urandom(5))
-        self._store.save_confirmation_code(code, address)
+    def _send_code(self, address, loginid=None):
+        """
+        Raises:
+            TooManyConfirmationCodes
+        """
+        if self._code_limiter:
+            keys = ['address:' + address]
+            if loginid:
+                keys.append('login:%s' % self.login_key(loginid))
+            if not self._code_limiter.take(keys):
+                raise TooManyConfirmationCodes
+        code = None
+        # signed codes are not stored, so every claim sends a new one
+        if not self._signed_codes:
+            code = self._store.recent_code(address, self.code_reuse_seconds)
+            if code is True:
+                # store keeps only digests, the email already sent has a valid code
+                return
+        if not code:
+            if self._signed_codes:
+                code = self._signed_codes.make(address)
+            else:
+                # os.urandom(5) will produce about 1 trillion possibilities
+                code = b32encode(os.urandom(5))
+                self._store.save_confirmation_code(code, address)
         self._mailer.send_code(code, address)
 
     def remind_pending_claim(self, loginid):
@@ -109,7 +256,10 @@ class CelRegistry(object):
                 # or they both point to different accounts
                 # in either case, there is no point in sending a confirmation code
                 return
-            self._send_code(login.address)
+            try:
+                self._send_code(login.address, loginid)
+            except TooManyConfirmationCodes:
+                pass # login proceeds, the user can ask for a code later
 
     def _handle_openid(self, openid_case):
         new_loginid = self._store.note_openid(openid_case)
@@ -133,7 +283,17 @@ class CelRegistry(object):
             self._store.set_account(loginid, new_account)
 
     def _handle_confirmation(self, code, loginid):
-        address = self._store.confirm_email(loginid, code)
+        if self._signed_codes:
+            address = self._signed_codes.verify(code) if code else None
+            # a code is used up only by a login it confirms
+            if address and self._store.get_address(loginid) not in (None, address):
+                address = None
+            if address and self._signed_codes.use(code):
+                address = self._store.confirm_address(loginid, address)
+            else:
+                address = None
+        else:
+            address = self._store.confirm_email(loginid, code)
         if not address:
             raise InvalidConfirmationCode
         account = self._store.account(loginid)
@@ -145,8 +305,9 @@ class CelRegistry(object):
             if account:
                 self._store.set_account(loginid, account)
 
-def make_auth_gate(registry_store, mailer, session_store):
-        registry = CelRegistry(registry_store, mailer)
+def make_auth_gate(registry_store, mailer, session_store, code_limiter=None,
+                   signed_codes=None):
+        registry = CelRegistry(registry_store, mailer, code_limiter, signed_codes)
         session = CelSession(session_store)
         return AuthGate(registry, session)
 
@@ -154,54 +315,93 @@ class AuthGate():
     def __init__(self, cel_registry, cel_session):
         self._registry = cel_registry
         self._session = cel_session
+        self._login_cache = dict()
+        self._equiv_logins = None
+        self._loginid = None
+        self._loginid_resolved = False
+
+    def _get_login(self, loginid):
+        """Get CelLogin from identity map of logins looked up during this gate's life"""
+        if loginid not in self._login_cache:
+            self._login_cache[loginid] = self._registry.get_login(loginid)
+        return self._login_cache[loginid]
+
+    def _invalidate(self):
+        self._login_cache.clear()
+        self._equiv_logins = None
 
     @property
     def loginid(self):
-        return self._session.loginid
+        if not self._loginid_resolved:
+            key = self._session.loginid
+            self._loginid = self._registry.login_by_key(key) if key else None
+            self._loginid_resolved = True
+        return self._loginid
+
+    def _set_loginid(self, loginid):
+        self._loginid = loginid
+        self._loginid_resolved = True
+        if loginid:
+            self._session.account = self.account
+            self._session.loginid = self._registry.login_key(loginid)
+        else:
+            self._session.clear()
 
     @property
     def account(self):
-        return self._registry.get_login(self.loginid).account if self.loginid else None
+        return self._get_login(self.loginid).account if self.loginid else None
 
     @property
     def _logins(self):
-        return map(self._registry.get_login, self._registry._equiv_loginids(self.loginid))
+        """Snapshot of (loginid, address, confirmed) for logins of the current account"""
+        if self._equiv_logins is None:
+            self._equiv_logins = self._registry._equiv_logins(self.loginid)
+        return self._equiv_logins
 
     def addresses(self):
-        return list(set([ l.address for l in self._logins ]))
+        return list(set([ address for l, address, c in self._logins if address ]))
 
     def addresses_pending(self):
-        return list(set([ l.address for l in self._logins if not l.confirmed ]))
+        return list(set([ address for l, address, confirmed in self._logins
+                          if address and not confirmed ]))
 
     def addresses_confirmed(self):
-        return list(set([ l.address for l in self._logins if l.confirmed ]))
+        return list(set([ address for l, address, confirmed in self._logins
+                          if address and confirmed ]))
 
     def must_join_account(self):
         if not self.loginid:
             return False
-        return self._registry.get_login(self.loginid).must_join_account()
+        return self._get_login(self.loginid).must_join_account()
 
     def login(self, openid_case):
         """
         Raises:
             AccountConflict
         """
-        new_loginid = self._registry._handle_openid(openid_case)
-        self._registry._join_logins(self.loginid, new_loginid)
+        self._invalidate()
+        with self._registry.atomic():
+            new_loginid = self._registry._handle_openid(openid_case)
+            self._registry._join_logins(self.loginid, new_loginid)
         self._registry.remind_pending_claim(new_loginid)
-        self._session.loginid = new_loginid
+        self._set_loginid(new_loginid)
 
     def logout(self):
-        self._session.clear()
+        self._invalidate()
+        self._set_loginid(None)
 
     def claim(self, email_address):
+        """
+        Raises:
+            TooManyConfirmationCodes
+        """
         address = normalize_email(email_address)
-        self._registry._send_code(address)
+        self._registry._send_code(address, self.loginid)
 
     def confirmation_required(self):
         if not self.loginid:
             return False
-        return self._registry.get_login(self.loginid).confirmation_required()
+        return self._get_login(self.loginid).confirmation_required()
 
     def confirm_email(self, code):
         """Register that login is confirming email confirmation code.
@@ -210,13 +410,16 @@ class AuthGate():
             AddressAccountConflict: Email address is already assigned to
                 another acccount.
         """
-        self._registry._handle_confirmation(code, self.loginid)
+        self._invalidate()
+        with self._registry.atomic():
+            self._registry._handle_confirmation(code, self.loginid)
+        self._session.account = self.account
         self._session.account_update()
 
     def can_create_account(self):
         if not self.loginid:
             return False
-        return self._registry.get_login(self.loginid).can_create_account()
+        return self._get_login(self.loginid).can_create_account()
 
     def create_account(self):
         if not self.loginid:
@@ -225,6 +428,9 @@ class AuthGate():
             raise AccountAlreadyExists
         if not self.can_create_account():
             raise AuthError("Account can not be created") 
-        self._registry.get_login(self.loginid).create_account()
+        with self._registry.atomic():
+            self._get_login(self.loginid).create_account()
+        self._invalidate()
+        self._session.account = self.account
         self._session.account_update()
 
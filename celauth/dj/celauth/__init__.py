@@ -1,32 +1,103 @@
-from celauth.providers import enable_test_openids
+import threading
+from celauth.providers import enable_test_openids, warm_discovery_cache
 from django.conf import settings
-from django.core.mail import send_mail
-from django.core.urlresolvers import reverse
-from django.template.loader import render_to_string
+from django.core.mail import EmailMessage
+from django.core.urlresolvers import reverse, get_script_prefix
+from django.template import Context
+from django.template.loader import get_template
+from django.test.signals import setting_changed
+from django.utils.module_loading import import_by_path
+from django.utils.safestring import mark_safe
 import django.contrib.auth
 
 if settings.DEBUG:
     enable_test_openids()
 
+if getattr(settings, 'CEL_WARM_OPENID_DISCOVERY', False):
+    warmer = threading.Thread(target=warm_discovery_cache)
+    warmer.daemon = True
+    warmer.start()
+
+_delivery = None
+_delivery_lock = threading.Lock()
+
+def get_delivery():
+    """Process-wide mail delivery backend named by settings.CEL_MAIL_DELIVERY"""
+    global _delivery
+    with _delivery_lock:
+        if _delivery is None:
+            path = getattr(settings, 'CEL_MAIL_DELIVERY',
+                           'celauth.dj.celauth.delivery.SyncDelivery')
+            _delivery = import_by_path(path)()
+    return _delivery
+
+_templates = dict()
+_url_prefixes = dict()
+
+def _render(template_name, vals):
+    """Same as render_to_string, but loading and compiling a template once per process"""
+    template = _templates.get(template_name)
+    if template is None:
+        template = _templates.setdefault(template_name, get_template(template_name))
+    return template.render(Context(vals))
+
+def _url_prefix(viewname):
+    """URL of view taking a confirmation code argument, without the code"""
+    key = (viewname, get_script_prefix())
+    prefix = _url_prefixes.get(key)
+    if prefix is None:
+        prefix = _url_prefixes.setdefault(key, reverse(viewname, args=['']))
+    return prefix
+
+_fragments = dict()
+
+def provider_buttons_html(choices, any_openid):
+    """Rendered buttons of (button name, text) choices, and of any OpenID if
+    any_openid, rendered once per process
+    """
+    key = (tuple(choices), bool(any_openid))
+    html = _fragments.get(key)
+    if html is None:
+        vals = { 'choices': key[0], 'any_openid': key[1] }
+        html = _fragments.setdefault(key, mark_safe(_render("celauth/provider_buttons.html", vals)))
+    return html
+
+def _clear_template_caches(setting, **kwargs):
+    if setting.startswith('TEMPLATE') or setting == 'ROOT_URLCONF':
+        _templates.clear()
+        _url_prefixes.clear()
+        _fragments.clear()
+
+setting_changed.connect(_clear_template_caches)
+
 class Mailer:
-    def __init__(self, request, viewname):
+    def __init__(self, request, viewname, delivery=None):
         if 'HTTP_HOST' in request.META:
             self.root = "https" if request.is_secure() else "http"
             self.root += "://" + request.META['HTTP_HOST']
         else:
             self.root = None
         self.viewname = viewname
+        self.delivery = delivery or get_delivery()
 
-    def send_code(self, code, address):
+    def message(self, code, address):
         vals = { 'code':code, 'url':None }
         if self.root:
-            vals['url'] = self.root + reverse(self.viewname, args=[code])
-        subject = render_to_string("celauth/confirm_email_subject.txt", vals)
+            vals['url'] = self.root + _url_prefix(self.viewname) + code
+        subject = _render("celauth/confirm_email_subject.txt", vals)
         subject = str.join("", subject.splitlines())
-        body = render_to_string("celauth/confirm_email_body.txt", vals)
-        send_mail(subject, body, settings.CONFIRM_EMAIL_FROM, [address])
+        body = _render("celauth/confirm_email_body.txt", vals)
+        return EmailMessage(subject, body, settings.CONFIRM_EMAIL_FROM, [address])
+
+    def send_code(self, code, address):
+        self.delivery.deliver(self.message(code, address), (address, code))
 
 class DjangoCelSessionStore(object):
+    """CelSession state in the Django session.
+
+    Updates mark the session modified, for the session middleware to save it
+    once per response. Callers outside of the middleware call flush().
+    """
 
     def __init__(self, request):
         self.request = request
@@ -37,6 +108,10 @@ class DjangoCelSessionStore(object):
         return self.request.session['authgate']
 
     def update(self):
+        self.request.session.modified = True
+
+    def flush(self):
+        """Save the session now"""
         self.request.session.save()
 
 class DjangoAuthCelSessionStore(DjangoCelSessionStore):
@@ -45,8 +120,7 @@ class DjangoAuthCelSessionStore(DjangoCelSessionStore):
         DjangoCelSessionStore.__init__(self, request)
 
     def update(self):
-        loginid = self.vals.get('loginid', None)
-        user_id = loginid.account if loginid else None
+        user_id = self.vals.get('account', None)
         if self.request.user.is_authenticated():
             if user_id != self.request.user.id:
                 django.contrib.auth.logout(self.request)
@@ -54,5 +128,5 @@ class DjangoAuthCelSessionStore(DjangoCelSessionStore):
             user = django.contrib.auth.authenticate(user_id=user_id)
             assert user
             django.contrib.auth.login(self.request, user)
-        self.request.session.save()
+        DjangoCelSessionStore.update(self)
 
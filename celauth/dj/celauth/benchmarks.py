@@ -0,0 +1,189 @@
+""" Query-count, wall time and allocation regression harness for the login flow.
+
+Drives the celauth views of the running project with the Django test client and
+the TestOpenIDHelper test OpenIDs.
+"""
+
+import gc
+import json
+import re
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.core import mail
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.template.loader import render_to_string
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils.module_loading import import_by_path
+from celauth.core import make_auth_gate
+from celauth.dj.celauth import Mailer
+from celauth.dj.celauth.cache import cached_registry_store
+from celauth.dj.celauth.codes import signed_codes
+from celauth.dj.celauth.models import DjangoCelModelStore
+from celauth.dj.celauth.ratelimit import code_limiter
+from celauth.dj.celauth.views import AuthGateFactory, get_auth_gate
+
+DEFAULT_MAX_SECONDS = 1.0
+
+# statements of transaction and savepoint handling, which differ by whether
+# the flow runs within a test case's transaction, so are not counted
+# (sqlite records statements as "QUERY = u'...' - PARAMS = ...")
+TRANSACTION_STATEMENT = re.compile(r"^(QUERY = u?')?(BEGIN|SAVEPOINT|RELEASE SAVEPOINT|"
+                                   r"ROLLBACK TO SAVEPOINT)\b", re.IGNORECASE)
+
+def _counted(queries):
+    return [q for q in queries if not TRANSACTION_STATEMENT.match(q['sql'])]
+
+class LoginFlowReport(object):
+    def __init__(self, project, max_queries=None):
+        self.project = project
+        self.steps = []
+        self._max_queries = max_queries or dict()
+
+    @contextmanager
+    def step(self, name):
+        """Record queries, seconds and net new gc tracked objects of a step"""
+        gc.collect()
+        gc.disable() # so cyclic garbage allocated by the step is counted
+        try:
+            objects = len(gc.get_objects())
+            with CaptureQueriesContext(connection) as queries:
+                start = time.time()
+                yield
+                seconds = time.time() - start
+            net_objects = len(gc.get_objects()) - objects
+        finally:
+            gc.enable()
+        self.steps.append({
+            'step': name,
+            'queries': len(_counted(queries)),
+            'seconds': seconds,
+            'net_objects': net_objects,
+            'max_queries': self._max_queries.get(name, None),
+            'max_seconds': DEFAULT_MAX_SECONDS,
+        })
+
+    def regressions(self):
+        ret = []
+        for s in self.steps:
+            if s['max_queries'] is not None and s['queries'] > s['max_queries']:
+                ret.append("%(step)s: %(queries)i queries > %(max_queries)i" % s)
+            if s['seconds'] > s['max_seconds']:
+                ret.append("%(step)s: %(seconds).3f seconds > %(max_seconds).3f" % s)
+        return ret
+
+    def as_json(self):
+        return json.dumps({
+            'project': self.project,
+            'steps': self.steps,
+            'regressions': self.regressions(),
+        }, indent=2, sort_keys=True)
+
+def run_login_flow(client, name='bench', tld='com'):
+    """Create a new account via the login, login_return, enter_address,
+    confirm_email and create_account views, then log out.
+    Requires test OpenIDs enabled. Steps are checked against the maximum
+    queries per step of settings.CEL_BENCHMARK_MAX_QUERIES, if any.
+    """
+    report = LoginFlowReport(settings.SETTINGS_MODULE,
+                             getattr(settings, 'CEL_BENCHMARK_MAX_QUERIES', None))
+    host = {'HTTP_HOST': 'testserver'}
+    next_url = '/there'
+
+    with report.step('login_page'):
+        response = client.get(reverse('celauth:login'), {'next': next_url}, **host)
+    assert response.status_code == 200
+
+    data = {
+        'openid_identifier': 'https://example.%s/%s' % (tld, name),
+        'login': 'Log in',
+        'next': next_url,
+    }
+    with report.step('login'):
+        response = client.post(reverse('celauth:login'), data, **host)
+    assert response.status_code == 302
+
+    with report.step('login_return'):
+        response = client.get(response['Location'], **host)
+    assert 'id_address' in response.content
+
+    mail.outbox = []
+    data = {'address': '%s@example.%s' % (name, tld), 'next': next_url}
+    with report.step('enter_address'):
+        response = client.post(reverse('celauth:enter_address'), data, **host)
+    assert len(mail.outbox) == 1
+
+    url = mail.outbox[0].body.split('\n')[1] #url on 2nd line
+    with report.step('confirm_email'):
+        response = client.get(url, {'next': next_url}, **host)
+    assert "Create new account" in response.content
+
+    with report.step('create_account'):
+        response = client.post(reverse('celauth:create_account'), {'next': next_url}, **host)
+    assert response.status_code == 302
+
+    with report.step('logout'):
+        response = client.post(reverse('celauth:logout'), **host)
+    assert response.status_code == 200
+
+    return report
+
+def _message_uncached(mailer, code, address):
+    # how Mailer built messages before templates and URL prefix were cached
+    vals = { 'code':code, 'url':None }
+    if mailer.root:
+        vals['url'] = mailer.root + reverse(mailer.viewname, args=[code])
+    subject = render_to_string("celauth/confirm_email_subject.txt", vals)
+    subject = str.join("", subject.splitlines())
+    body = render_to_string("celauth/confirm_email_body.txt", vals)
+    return subject, body
+
+def time_mailer(count=1000):
+    """Seconds per confirmation email built by render_to_string and reverse
+    versus by Mailer's precompiled templates and cached URL prefix.
+    """
+    request = RequestFactory().get('/', HTTP_HOST='testserver')
+    mailer = Mailer(request, 'celauth:confirm_email', delivery=object())
+    codes = ['CODE%04i' % i for i in range(count)]
+    start = time.time()
+    for code in codes:
+        _message_uncached(mailer, code, 'joe@example.com')
+    uncached = (time.time() - start) / count
+    start = time.time()
+    for code in codes:
+        mailer.message(code, 'joe@example.com')
+    cached = (time.time() - start) / count
+    return {'render_to_string': uncached, 'precompiled': cached}
+
+def _auth_gate_per_call(request):
+    # how views made an AuthGate before AuthGateFactory, on every call
+    AccountManager = import_by_path(settings.CEL_ACCOUNTANT)
+    mailer = Mailer(request, 'celauth:confirm_email')
+    registry_store = cached_registry_store(DjangoCelModelStore(AccountManager()))
+    SessionStore = import_by_path(settings.CEL_SESSION_STORE)
+    return make_auth_gate(registry_store, mailer, SessionStore(request),
+                          code_limiter(), signed_codes())
+
+def time_auth_gate(count=1000):
+    """Seconds per AuthGate made resolving settings on every call versus by
+    AuthGateFactory, and per get_auth_gate of a request already having one.
+    """
+    requests = [RequestFactory().get('/', HTTP_HOST='testserver') for i in range(count)]
+    start = time.time()
+    for request in requests:
+        _auth_gate_per_call(request)
+    per_call = (time.time() - start) / count
+    factory = AuthGateFactory()
+    start = time.time()
+    for request in requests:
+        factory(request)
+    factory_time = (time.time() - start) / count
+    request = requests[0]
+    get_auth_gate(request)
+    start = time.time()
+    for i in range(count):
+        get_auth_gate(request)
+    memoized = (time.time() - start) / count
+    return {'settings_per_call': per_call, 'factory': factory_time, 'memoized': memoized}
@@ -0,0 +1,155 @@
+""" Bulk import of an existing user base into the CEL registry, and export
+of the registry's account URIs.
+
+Records are dicts with an 'address' and optionally a 'claimed_id' and
+'display_id' of an OpenID, an 'account' and whether the address is
+'confirmed'. Records without an account get the account the accountant
+assigns to their address, if any. Existing EmailAddress accounts and
+existing OpenIDs are left as they are.
+
+Records are read and saved in chunks, so memory use does not grow with
+the input size. Cached registry store entries of the addresses of a chunk
+are dropped once the chunk is saved.
+"""
+
+import csv
+import json
+import time
+from collections import namedtuple
+from itertools import islice
+from django.db import transaction
+from celauth.core import normalize_email
+from celauth.dj.celauth.cache import _key, _LOGINS_VERSION, registry_cache
+from celauth.dj.celauth.models import EmailAddress, OpenID
+
+DEFAULT_BATCH_SIZE = 500
+
+TRUE_STRINGS = ('1', 'true', 'yes', 'y')
+
+class ImportResult(namedtuple('ImportResult',
+                              ['rows', 'addresses', 'openids', 'skipped', 'seconds'])):
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return ("%i rows imported, %i new addresses, %i new OpenIDs, %i rows skipped,"
+                " %.1f rows/s" % (self.rows, self.addresses, self.openids, self.skipped,
+                                  self.rows_per_second))
+
+def read_csv(lines):
+    """Records of CSV lines with a header row naming the columns"""
+    for row in csv.DictReader(lines):
+        yield dict((k, v.decode('utf-8')) for k, v in row.items() if v)
+
+def read_json_lines(lines):
+    """Records of lines each holding a JSON object"""
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
+
+def _flag(value):
+    if isinstance(value, basestring):
+        return value.strip().lower() in TRUE_STRINGS
+    return bool(value)
+
+def _account(value):
+    return int(value) if value not in (None, '') else None
+
+def _assigned_accounts(accountant, addresses):
+    if not addresses:
+        return dict()
+    # accountants may answer for many addresses in one go
+    bulk = getattr(accountant, 'assigned_accounts', None)
+    if bulk:
+        return bulk(addresses)
+    ret = dict()
+    for address in addresses:
+        account = accountant.assigned_account(address)
+        if account:
+            ret[address] = account
+    return ret
+
+def _import_chunk(records, accountant):
+    """Returns numbers of new EmailAddress rows, new OpenID rows and skipped records,
+    and the addresses of the records
+    """
+    addresses = [normalize_email(r.get('address')) for r in records]
+    skipped = addresses.count(None) + addresses.count('')
+    accounts = dict()
+    for address, record in zip(addresses, records):
+        if address and not accounts.get(address):
+            accounts[address] = _account(record.get('account'))
+
+    existing = dict(EmailAddress.objects.filter(pk__in=accounts.keys())
+                                        .values_list('address', 'account'))
+    for address, account in existing.items():
+        if account:
+            accounts[address] = account
+    unresolved = [a for a, account in accounts.items() if not account]
+    accounts.update(_assigned_accounts(accountant, unresolved))
+
+    EmailAddress.objects.bulk_create([EmailAddress(address=a, account=accounts[a])
+                                      for a in accounts if a not in existing])
+    gaining = dict()
+    for address, account in existing.items():
+        if not account and accounts[address]:
+            gaining.setdefault(accounts[address], []).append(address)
+    for account, some in gaining.items():
+        EmailAddress.objects.filter(pk__in=some, account=None).update(account=account)
+
+    openids = dict()
+    for address, record in zip(addresses, records):
+        claimed_id = record.get('claimed_id')
+        if address and claimed_id and claimed_id not in openids:
+            openids[claimed_id] = OpenID(claimed_id=claimed_id,
+                                         display_id=record.get('display_id') or claimed_id,
+                                         email_id=address,
+                                         account=accounts[address],
+                                         confirmed=_flag(record.get('confirmed')))
+    found = set(OpenID.objects.filter(pk__in=openids.keys()).values_list('pk', flat=True))
+    OpenID.objects.bulk_create([o for o in openids.values() if o.pk not in found])
+    skipped += len(found)
+    return len(accounts) - len(existing), len(openids) - len(found), skipped, accounts.keys()
+
+def import_records(records, accountant, batch_size=DEFAULT_BATCH_SIZE):
+    """Import records in chunks of batch_size, each chunk in one transaction.
+    Returns an ImportResult.
+    """
+    start = time.time()
+    cache = registry_cache()
+    rows = new_addresses = new_openids = skipped = 0
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, batch_size))
+        if not chunk:
+            break
+        with transaction.atomic():
+            counts = _import_chunk(chunk, accountant)
+        if cache is not None:
+            # imported logins may have accounts too
+            cache.delete_many([_key('address_version', a) for a in counts[3]]
+                              + [_LOGINS_VERSION])
+        rows += len(chunk)
+        new_addresses += counts[0]
+        new_openids += counts[1]
+        skipped += counts[2]
+    return ImportResult(rows, new_addresses, new_openids, skipped, time.time() - start)
+
+def export_json_lines(store, out, group=False, batch_size=DEFAULT_BATCH_SIZE):
+    """Write account URIs of a DjangoCelModelStore as JSON lines, either one
+    {"account": ..., "uri": ...} object per URI, or if group is true, one
+    {"account": ..., "uris": [...]} object per account.
+    Returns number of lines written.
+    """
+    if group:
+        lines = ({'account': account, 'uris': uris}
+                 for account, uris in store.account_groups(batch_size))
+    else:
+        lines = ({'account': account, 'uri': uri}
+                 for account, uri in store.account_uris(batch_size))
+    count = 0
+    for line in lines:
+        out.write(json.dumps(line, sort_keys=True) + '\n')
+        count += 1
+    return count
@@ -0,0 +1,235 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from hashlib import md5
+from uuid import uuid4
+from django.conf import settings
+from django.core.cache import get_cache
+from django.test.signals import setting_changed
+
+def _key(kind, value):
+    # hash to keep keys short and safe for memcached
+    value = getattr(value, 'pk', value)
+    return 'celauth:%s:%s' % (kind, md5(unicode(value).encode('utf-8')).hexdigest())
+
+# version of all assigned_account entries naming an account, which change
+# when that account gets a login
+_LOGINS_VERSION = 'celauth:logins_version'
+
+class CachedCelRegistryStore(object):
+    """Registry store wrapper caching whether addresses are free and which
+    accounts they are assigned in a Django cache backend.
+
+    Entries are tagged with version tokens read before asking the store: one
+    per address, and one for all logins. Writes made through the wrapper
+    delete the affected tokens once committed, which also drops entries of
+    values read before the commit, in any process. Within atomic() the cache
+    is bypassed. Writes made elsewhere are seen once cache entries time out.
+    """
+
+    def __init__(self, registry_store, cache):
+        self._store = registry_store
+        self._cache = cache
+        self._stale = None # version keys to delete once atomic() commits
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def __getattr__(self, name):
+        return getattr(self._store, name)
+
+    @contextmanager
+    def atomic(self):
+        if self._stale is not None:
+            yield
+            return
+        self._stale = set()
+        try:
+            with self._store.atomic():
+                yield
+            stale = self._stale
+        finally:
+            self._stale = None
+        self._cache.delete_many(list(stale))
+
+    def _invalidate(self, *keys):
+        if self._stale is not None:
+            self._stale.update(keys)
+        else:
+            self._cache.delete_many(list(keys))
+
+    def _versions(self, keys):
+        found = self._cache.get_many(keys)
+        ret = []
+        for key in keys:
+            token = found.get(key)
+            if token is None:
+                token = uuid4().hex
+                if not self._cache.add(key, token):
+                    token = self._cache.get(key)
+            ret.append((key, token))
+        return tuple(ret)
+
+    def _cached(self, question, address):
+        if self._stale is not None:
+            return None
+        entry = self._cache.get(_key(question, address))
+        if entry is None:
+            return None
+        value, versions = entry
+        found = self._cache.get_many([key for key, token in versions])
+        for key, token in versions:
+            if token is None or found.get(key) != token:
+                return None
+        self.hits[question] += 1
+        return entry
+
+    def is_free_address(self, address):
+        entry = self._cached('is_free_address', address)
+        if entry:
+            return entry[0]
+        self.misses['is_free_address'] += 1
+        if self._stale is not None:
+            return self._store.is_free_address(address)
+        versions = self._versions([_key('address_version', address)])
+        ret = self._store.is_free_address(address)
+        self._cache.set(_key('is_free_address', address), (ret, versions))
+        return ret
+
+    def assigned_account(self, address):
+        entry = self._cached('assigned_account', address)
+        if entry:
+            return entry[0]
+        self.misses['assigned_account'] += 1
+        if self._stale is not None:
+            return self._store.assigned_account(address)
+        keys = [_key('address_version', address), _LOGINS_VERSION]
+        versions = self._versions(keys)
+        ret = self._store.assigned_account(address)
+        if ret:
+            # store might have assigned the address an account from the accountant
+            self._cache.delete(keys[0])
+            versions = self._versions(keys)
+        else:
+            # no account, or one with logins already
+            versions = versions[:1]
+        self._cache.set(_key('assigned_account', address), (ret, versions))
+        return ret
+
+    def assign(self, address, account):
+        self._store.assign(address, account)
+        self._invalidate(_key('address_version', address))
+
+    def add_address(self, account, address):
+        ret = self._store.add_address(account, address)
+        self._invalidate(_key('address_version', address))
+        return ret
+
+    def set_account(self, loginid, account):
+        self._store.set_account(loginid, account)
+        self._invalidate(_LOGINS_VERSION)
+
+    def create_account(self, loginid):
+        account = self._store.create_account(loginid)
+        if isinstance(loginid, basestring) and loginid.startswith('mailto:'):
+            self._invalidate(_key('address_version', loginid[7:]))
+        else:
+            self._invalidate(_LOGINS_VERSION)
+        return account
+
+def registry_cache():
+    """Cache named by settings.CEL_REGISTRY_CACHE, or None"""
+    alias = getattr(settings, 'CEL_REGISTRY_CACHE', None)
+    return get_cache(alias) if alias else None
+
+def cached_registry_store(registry_store):
+    """Wrap registry store with the cache named by settings.CEL_REGISTRY_CACHE, if any"""
+    cache = registry_cache()
+    if cache is None:
+        return registry_store
+    return CachedCelRegistryStore(registry_store, cache)
+
+class AssociationCache(object):
+    """Thread-safe cache of decoded OpenID associations by (server_url, handle).
+
+    A handle of None caches the latest association of server_url.
+    With a backend, a Django cache shared with other processes, entries live
+    there until the association expires, and a removal in any process is seen
+    by all. Without one, entries live in an LRU of this process for at most
+    ttl seconds, so other processes may keep using a removed association
+    that long. The backend defaults to the cache named by
+    settings.CEL_OPENID_ASSOCIATION_CACHE, set up once per thread.
+    """
+
+    def __init__(self, max_size=256, ttl=60, backend=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._backend = backend
+        self._local = threading.local()
+        self._entries = OrderedDict() # key -> (expiration time, association)
+        self._lock = threading.Lock()
+
+    def _shared(self):
+        if self._backend is not None:
+            return self._backend
+        local = self._local
+        if not hasattr(local, 'backend'):
+            alias = getattr(settings, 'CEL_OPENID_ASSOCIATION_CACHE', None)
+            local.backend = get_cache(alias) if alias else None
+        return local.backend
+
+    def get(self, server_url, handle):
+        key = (server_url, handle)
+        shared = self._shared()
+        if shared is not None:
+            association = shared.get(_key('association', key))
+            if association and association.getExpiresIn() > 0:
+                return association
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry and entry[0] > now:
+                self._entries[key] = entry
+                return entry[1]
+        return None
+
+    def put(self, server_url, handle, association):
+        key = (server_url, handle)
+        shared = self._shared()
+        if shared is not None:
+            shared.set(_key('association', key), association, association.getExpiresIn())
+            return
+        expiration = time.time() + min(self.ttl, association.getExpiresIn())
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expiration, association)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, server_url, handle):
+        keys = [(server_url, handle), (server_url, None)]
+        shared = self._shared()
+        if shared is not None:
+            shared.delete_many([_key('association', key) for key in keys])
+            return
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def reset(self):
+        """Forget entries and the backends set up from settings"""
+        self._local = threading.local()
+        self.clear()
+
+association_cache = AssociationCache()
+
+def _reset_association_cache(setting, **kwargs):
+    if setting in ('CEL_OPENID_ASSOCIATION_CACHE', 'CACHES'):
+        association_cache.reset()
+
+setting_changed.connect(_reset_association_cache)
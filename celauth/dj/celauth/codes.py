@@ -0,0 +1,46 @@
+""" Stateless signed confirmation codes, see celauth.core.SignedCodes.
+"""
+
+import time
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from celauth.core import SignedCodes
+from celauth.dj.celauth.cache import _key
+from celauth.dj.celauth.models import CODE_LIFETIME
+
+# cache backends keeping nothing, or keeping entries within one process
+UNSHARED_CACHES = (DummyCache, LocMemCache)
+
+class CacheReplaySet(object):
+    """Used codes remembered in a Django cache until they expire"""
+
+    def __init__(self, cache):
+        self._cache = cache
+
+    def add(self, code, expiration):
+        timeout = max(1, int(expiration - time.time()))
+        return self._cache.add(_key('used_code', code), True, timeout)
+
+def signed_codes():
+    """Signed confirmation codes if settings.CEL_SIGNED_CODES is true,
+    otherwise None for codes saved in the database.
+
+    Used codes are remembered in the cache named by CEL_SIGNED_CODES_CACHE,
+    which must be shared by all processes, lest another process accept a
+    used code again.
+    """
+    if not getattr(settings, 'CEL_SIGNED_CODES', False):
+        return None
+    alias = getattr(settings, 'CEL_SIGNED_CODES_CACHE', None)
+    if not alias:
+        raise ImproperlyConfigured("CEL_SIGNED_CODES requires CEL_SIGNED_CODES_CACHE")
+    cache = get_cache(alias)
+    if isinstance(cache, UNSHARED_CACHES):
+        raise ImproperlyConfigured("CEL_SIGNED_CODES_CACHE '%s' is not shared"
+                                   " between processes" % alias)
+    replay_set = CacheReplaySet(cache)
+    lifetime = CODE_LIFETIME.days * 24 * 60 * 60 + CODE_LIFETIME.seconds
+    return SignedCodes(settings.SECRET_KEY, replay_set, lifetime)
@@ -0,0 +1,264 @@
+""" Delivery backends for confirmation code emails.
+
+Select one with settings.CEL_MAIL_DELIVERY, the default being SyncDelivery.
+Backends deliver an EmailMessage given a key identifying identical sends,
+such as an (address, code) pair, and skip sends of a key already pending.
+"""
+
+import atexit
+import logging
+import threading
+import time
+import weakref
+import Queue
+from collections import deque, namedtuple
+from datetime import datetime, timedelta
+from hashlib import sha1
+from django.core.mail import EmailMessage, get_connection
+from django.db import IntegrityError, transaction
+from celauth.dj.celauth.models import OutboxEmail
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+BACKOFF_SECONDS = 60
+
+def backoff(attempts, base=BACKOFF_SECONDS):
+    """Seconds to wait before retrying after attempts failures"""
+    return base * 2 ** (attempts - 1)
+
+class SyncDelivery(object):
+    """Send within the calling request"""
+
+    def deliver(self, message, key):
+        message.send()
+
+class ThreadPoolDelivery(object):
+    """Send from a bounded pool of worker threads in this process.
+
+    When the queue is full, messages are sent within the calling request,
+    with one attempt only.
+    """
+
+    def __init__(self, workers=2, max_queued=1000, max_attempts=MAX_ATTEMPTS,
+                 backoff_seconds=1):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self._queue = Queue.Queue(max_queued)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def deliver(self, message, key):
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+            if not self._threads:
+                for i in range(self.workers):
+                    thread = threading.Thread(target=self._work)
+                    thread.daemon = True
+                    thread.start()
+                    self._threads.append(thread)
+        try:
+            self._queue.put_nowait((message, key))
+        except Queue.Full:
+            # within the request, so one attempt and no backoff
+            self._send(message, key, max_attempts=1)
+
+    def _work(self):
+        while True:
+            message, key = self._queue.get()
+            try:
+                self._send(message, key)
+            finally:
+                self._queue.task_done()
+
+    def _send(self, message, key, max_attempts=None):
+        max_attempts = max_attempts or self.max_attempts
+        try:
+            for attempts in range(1, max_attempts + 1):
+                try:
+                    message.send()
+                    return
+                except Exception:
+                    logger.exception("Sending confirmation email failed")
+                    if attempts < max_attempts:
+                        time.sleep(backoff(attempts, self.backoff_seconds))
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def join(self):
+        """Wait until all queued messages are sent or given up on"""
+        self._queue.join()
+
+class BatchStats(namedtuple('BatchStats', ['size', 'sent', 'seconds'])):
+    @property
+    def messages_per_second(self):
+        return self.sent / self.seconds if self.seconds else 0.0
+
+class BatchingDelivery(object):
+    """Accumulate messages and send each batch over one mail connection.
+
+    A batch is sent once it has max_batch messages or its first message has
+    waited max_wait seconds. Messages failing to send are queued again and
+    retried after a backoff, up to max_attempts sends each. Stats of recent
+    batches are kept in batches.
+    """
+
+    def __init__(self, max_batch=50, max_wait=1.0, max_attempts=MAX_ATTEMPTS,
+                 backoff_seconds=1):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.batches = deque(maxlen=100)
+        self._pending = [] # (message, key, failed attempts)
+        self._keys = set()
+        self._timer = None
+        self._lock = threading.Lock()
+        _batching.add(self)
+
+    def deliver(self, message, key):
+        with self._lock:
+            if key in self._keys:
+                return
+            self._keys.add(key)
+            self._pending.append((message, key, 0))
+            full = len(self._pending) >= self.max_batch
+            if not full:
+                self._schedule(self.max_wait)
+        if full:
+            self.flush()
+
+    def _schedule(self, seconds):
+        # with lock held
+        if self._timer is None:
+            self._timer = threading.Timer(seconds, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            batch = self._pending
+            self._pending = []
+            self._keys = set()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not batch:
+            return
+        start = time.time()
+        failures = []
+        connection = get_connection()
+        try:
+            connection.open()
+        except Exception:
+            logger.exception("Opening connection for %i confirmation emails failed", len(batch))
+            failures = batch
+        else:
+            try:
+                for item in batch:
+                    message = item[0]
+                    message.connection = connection
+                    try:
+                        message.send()
+                    except Exception:
+                        logger.exception("Sending confirmation email failed")
+                        failures.append(item)
+            finally:
+                connection.close()
+        if failures:
+            self._retry(failures)
+        stats = BatchStats(len(batch), len(batch) - len(failures), time.time() - start)
+        self.batches.append(stats)
+        logger.info("Sent %i of %i confirmation emails, %.1f messages/s",
+                    stats.sent, stats.size, stats.messages_per_second)
+
+    def _retry(self, batch):
+        retry = [(m, key, failed + 1) for m, key, failed in batch
+                 if failed + 1 < self.max_attempts]
+        if len(retry) < len(batch):
+            logger.error("Giving up on %i confirmation emails", len(batch) - len(retry))
+        if not retry:
+            return
+        with self._lock:
+            for message, key, failed in retry:
+                if key not in self._keys:
+                    self._keys.add(key)
+                    self._pending.append((message, key, failed))
+            self._schedule(backoff(min(f for m, key, f in retry), self.backoff_seconds))
+
+# flushed at exit, with one handler for all instances
+_batching = weakref.WeakSet()
+
+def _flush_batching():
+    for delivery in list(_batching):
+        delivery.flush()
+
+atexit.register(_flush_batching)
+
+def _outbox_key(key):
+    return sha1(repr(key)).hexdigest()
+
+class OutboxDelivery(object):
+    """Save messages in the outbox table, to be sent by drain_outbox.
+
+    Messages are saved as rendered, so until drained the table holds usable
+    confirmation codes, which are otherwise only stored as digests. Drain it
+    often where that matters.
+    """
+
+    def deliver(self, message, key):
+        try:
+            with transaction.atomic():
+                for recipient in message.to:
+                    OutboxEmail.objects.create(key=_outbox_key((key, recipient)),
+                                               from_email=message.from_email,
+                                               recipient=recipient,
+                                               subject=message.subject,
+                                               body=message.body,
+                                               next_attempt=datetime.utcnow())
+        except IntegrityError:
+            pass # already in the outbox
+
+def drain_outbox(batch_size=100, max_attempts=MAX_ATTEMPTS):
+    """Send outbox emails due for an attempt over one mail connection.
+    Emails failing their last attempt are deleted.
+    Returns numbers of emails sent and failed.
+    """
+    now = datetime.utcnow()
+    due = OutboxEmail.objects.filter(next_attempt__lte=now, attempts__lt=max_attempts)
+    due = list(due.order_by('next_attempt')[:batch_size])
+    sent = failed = 0
+    if not due:
+        return sent, failed
+    connection = get_connection()
+    connection.open()
+    try:
+        for email in due:
+            # claim the email so concurrent drains skip it
+            lease = now + timedelta(seconds=backoff(email.attempts + 1))
+            claimed = OutboxEmail.objects.filter(pk=email.pk, attempts=email.attempts,
+                                                 next_attempt=email.next_attempt)
+            if not claimed.update(attempts=email.attempts + 1, next_attempt=lease):
+                continue
+            message = EmailMessage(email.subject, email.body, email.from_email,
+                                   [email.recipient], connection=connection)
+            try:
+                message.send()
+            except Exception:
+                logger.exception("Sending outbox email %i failed", email.pk)
+                failed += 1
+                if email.attempts + 1 >= max_attempts:
+                    logger.error("Giving up on outbox email %i to %s after %i attempts",
+                                 email.pk, email.recipient, email.attempts + 1)
+                    OutboxEmail.objects.filter(pk=email.pk).delete()
+            else:
+                OutboxEmail.objects.filter(pk=email.pk).delete()
+                sent += 1
+    finally:
+        connection.close()
+    return sent, failed
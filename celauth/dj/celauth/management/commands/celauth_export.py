@@ -0,0 +1,21 @@
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from django.utils.module_loading import import_by_path
+from celauth.dj.celauth.bulk import export_json_lines, DEFAULT_BATCH_SIZE
+from celauth.dj.celauth.models import DjangoCelModelStore
+
+
+class Command(NoArgsCommand):
+    help = "Write the OpenID and mailto: URIs of every account as JSON lines, in account order."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--group', action='store_true', default=False,
+                    help="One line per account listing all its URIs."),
+        make_option('--batch-size', type='int', default=DEFAULT_BATCH_SIZE,
+                    help="Maximum rows read per query."),
+    )
+
+    def handle_noargs(self, **options):
+        store = DjangoCelModelStore(import_by_path(settings.CEL_ACCOUNTANT)())
+        export_json_lines(store, self.stdout, options['group'], options['batch_size'])
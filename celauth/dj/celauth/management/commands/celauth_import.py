@@ -0,0 +1,35 @@
+import sys
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_by_path
+from celauth.dj.celauth.bulk import import_records, read_csv, read_json_lines
+from celauth.dj.celauth.bulk import DEFAULT_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    args = "<file file ...>"
+    help = ("Import email addresses and OpenIDs of an existing user base from CSV files"
+            " with a header row or from JSON lines files, '-' being standard input.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', choices=['csv', 'jsonl'], default=None,
+                    help="Input format, by default guessed from the file name extension."),
+        make_option('--batch-size', type='int', default=DEFAULT_BATCH_SIZE,
+                    help="Maximum rows saved per transaction."),
+    )
+
+    def handle(self, *paths, **options):
+        if not paths:
+            raise CommandError("No files to import")
+        accountant = import_by_path(settings.CEL_ACCOUNTANT)()
+        for path in paths:
+            format = options['format'] or ('csv' if path.endswith('.csv') else 'jsonl')
+            read = read_csv if format == 'csv' else read_json_lines
+            lines = sys.stdin if path == '-' else open(path, 'rb')
+            try:
+                result = import_records(read(lines), accountant, options['batch_size'])
+            finally:
+                if lines is not sys.stdin:
+                    lines.close()
+            self.stdout.write("%s: %s" % (path, result))
@@ -0,0 +1,16 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from celauth.dj.celauth.delivery import drain_outbox
+
+
+class Command(NoArgsCommand):
+    help = "Can be run as a cronjob or directly to send emails queued by OutboxDelivery."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', default=100,
+                    help="Maximum emails sent per run."),
+    )
+
+    def handle_noargs(self, **options):
+        sent, failed = drain_outbox(batch_size=options['batch_size'])
+        self.stdout.write("%i sent, %i failed" % (sent, failed))
@@ -0,0 +1,16 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from celauth.dj.celauth.sweep import sweep_expired, DEFAULT_BATCH_SIZE
+
+
+class Command(NoArgsCommand):
+    help = "Can be run as a cronjob or directly to delete expired confirmation codes, OpenID nonces and OpenID associations, outbox emails given up on and refilled rate limit buckets."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', default=DEFAULT_BATCH_SIZE,
+                    help="Maximum rows deleted per statement."),
+    )
+
+    def handle_noargs(self, **options):
+        for result in sweep_expired(batch_size=options['batch_size']):
+            self.stdout.write(str(result))
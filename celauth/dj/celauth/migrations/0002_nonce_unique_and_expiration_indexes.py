@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding index on 'ConfirmationCode', fields ['expiration']
+        db.create_index(u'celauth_confirmationcode', ['expiration'])
+
+        # Adding index on 'OpenIDNonce', fields ['timestamp']
+        db.create_index(u'celauth_openidnonce', ['timestamp'])
+
+        # Removing duplicate nonces the unique constraint would reject
+        if not db.dry_run:
+            duplicates = orm.OpenIDNonce.objects.values('server_url', 'timestamp', 'salt')
+            duplicates = duplicates.annotate(n=models.Count('id')).filter(n__gt=1)
+            for dup in duplicates:
+                del dup['n']
+                keep = orm.OpenIDNonce.objects.filter(**dup).order_by('id')[0]
+                orm.OpenIDNonce.objects.filter(**dup).exclude(id=keep.id).delete()
+
+        # Adding unique constraint on 'OpenIDNonce', fields ['server_url', 'timestamp', 'salt']
+        db.create_unique(u'celauth_openidnonce', ['server_url', 'timestamp', 'salt'])
+
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'OpenIDNonce', fields ['server_url', 'timestamp', 'salt']
+        db.delete_unique(u'celauth_openidnonce', ['server_url', 'timestamp', 'salt'])
+
+        # Removing index on 'OpenIDNonce', fields ['timestamp']
+        db.delete_index(u'celauth_openidnonce', ['timestamp'])
+
+        # Removing index on 'ConfirmationCode', fields ['expiration']
+        db.delete_index(u'celauth_confirmationcode', ['expiration'])
+
+
+    models = {
+        u'celauth.confirmationcode': {
+            'Meta': {'object_name': 'ConfirmationCode'},
+            'code': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '64'}),
+            'email': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['celauth.EmailAddress']"}),
+            'expiration': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        u'celauth.emailaddress': {
+            'Meta': {'object_name': 'EmailAddress'},
+            'account': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            'address': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'primary_key': 'True'})
+        },
+        u'celauth.openid': {
+            'Meta': {'object_name': 'OpenID'},
+            'account': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            'claimed_id': ('django.db.models.fields.URLField', [], {'max_length': '255', 'primary_key': 'True'}),
+            'confirmed': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'display_id': ('django.db.models.fields.URLField', [], {'max_length': '255'}),
+            'email': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['celauth.EmailAddress']", 'null': 'True', 'blank': 'True'})
+        },
+        u'celauth.openidassociation': {
+            'Meta': {'object_name': 'OpenIDAssociation'},
+            'assoc_type': ('django.db.models.fields.TextField', [], {'max_length': '64'}),
+            'handle': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'issued': ('django.db.models.fields.IntegerField', [], {}),
+            'lifetime': ('django.db.models.fields.IntegerField', [], {}),
+            'secret': ('django.db.models.fields.TextField', [], {'max_length': '255'}),
+            'server_url': ('django.db.models.fields.URLField', [], {'max_length': '200', 'db_index': 'True'})
+        },
+        u'celauth.openidnonce': {
+            'Meta': {'unique_together': "(('server_url', 'timestamp', 'salt'),)", 'object_name': 'OpenIDNonce'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'salt': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'server_url': ('django.db.models.fields.URLField', [], {'max_length': '255'}),
+            'timestamp': ('django.db.models.fields.IntegerField', [], {'db_index': 'True'})
+        }
+    }
+
+    complete_apps = ['celauth']
\ No newline at end of file
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'OutboxEmail'
+        db.create_table(u'celauth_outboxemail', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('key', self.gf('django.db.models.fields.CharField')(unique=True, max_length=40)),
+            ('from_email', self.gf('django.db.models.fields.CharField')(max_length=255)),
+            ('recipient', self.gf('django.db.models.fields.EmailField')(max_length=75)),
+            ('subject', self.gf('django.db.models.fields.CharField')(max_length=255)),
+            ('body', self.gf('django.db.models.fields.TextField')()),
+            ('attempts', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('next_attempt', self.gf('django.db.models.fields.DateTimeField')(db_index=True)),
+        ))
+        db.send_create_signal(u'celauth', ['OutboxEmail'])
+
+
+    def backwards(self, orm):
+        # Deleting model 'OutboxEmail'
+        db.delete_table(u'celauth_outboxemail')
+
+
+    models = {
+        u'celauth.confirmationcode': {
+            'Meta': {'object_name': 'ConfirmationCode'},
+            'code': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '64'}),
+            'email': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['celauth.EmailAddress']"}),
+            'expiration': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        u'celauth.emailaddress': {
+            'Meta': {'object_name': 'EmailAddress'},
+            'account': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            'address': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'primary_key': 'True'})
+        },
+        u'celauth.openid': {
+            'Meta': {'object_name': 'OpenID'},
+            'account': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            'claimed_id': ('django.db.models.fields.URLField', [], {'max_length': '255', 'primary_key': 'True'}),
+            'confirmed': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'display_id': ('django.db.models.fields.URLField', [], {'max_length': '255'}),
+            'email': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['celauth.EmailAddress']", 'null': 'True', 'blank': 'True'})
+        },
+        u'celauth.openidassociation': {
+            'Meta': {'object_name': 'OpenIDAssociation'},
+            'assoc_type': ('django.db.models.fields.TextField', [], {'max_length': '64'}),
+            'handle': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'issued': ('django.db.models.fields.IntegerField', [], {}),
+            'lifetime': ('django.db.models.fields.IntegerField', [], {}),
+            'secret': ('django.db.models.fields.TextField', [], {'max_length': '255'}),
+            'server_url': ('django.db.models.fields.URLField', [], {'max_length': '200', 'db_index': 'True'})
+        },
+        u'celauth.openidnonce': {
+            'Meta': {'unique_together': "(('server_url', 'timestamp', 'salt'),)", 'object_name': 'OpenIDNonce'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'salt': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'server_url': ('django.db.models.fields.URLField', [], {'max_length': '255'}),
+            'timestamp': ('django.db.models.fields.IntegerField', [], {'db_index': 'True'})
+        },
+        u'celauth.outboxemail': {
+            'Meta': {'object_name': 'OutboxEmail'},
+            'attempts': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'body': ('django.db.models.fields.TextField', [], {}),
+            'from_email': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'key': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '40'}),
+            'next_attempt': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            'recipient': ('django.db.models.fields.EmailField', [], {'max_length': '75'}),
+            'subject': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        }
+    }
+
+    complete_apps = ['celauth']
\ No newline at end of file
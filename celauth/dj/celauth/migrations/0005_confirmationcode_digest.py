@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+from django.utils.crypto import salted_hmac
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'ConfirmationCode.digest'
+        db.add_column(u'celauth_confirmationcode', 'digest',
+                      self.gf('django.db.models.fields.CharField')(default='', max_length=40),
+                      keep_default=False)
+
+        # Replacing codes by their digests
+        if not db.dry_run:
+            for pk, code in db.execute("SELECT id, code FROM celauth_confirmationcode"):
+                digest = salted_hmac('celauth.ConfirmationCode', code).hexdigest()
+                db.execute("UPDATE celauth_confirmationcode SET digest = %s WHERE id = %s",
+                           [digest, pk])
+
+        # Removing unique constraint on 'ConfirmationCode', fields ['code']
+        db.delete_unique(u'celauth_confirmationcode', ['code'])
+
+        # Deleting field 'ConfirmationCode.code'
+        db.delete_column(u'celauth_confirmationcode', 'code')
+
+        # Adding unique constraint on 'ConfirmationCode', fields ['digest']
+        db.create_unique(u'celauth_confirmationcode', ['digest'])
+
+
+    def backwards(self, orm):
+        # Codes can not be recovered from digests, so pending codes are dropped
+        db.execute("DELETE FROM celauth_confirmationcode")
+
+        # Removing unique constraint on 'ConfirmationCode', fields ['digest']
+        db.delete_unique(u'celauth_confirmationcode', ['digest'])
+
+        # Deleting field 'ConfirmationCode.digest'
+        db.delete_column(u'celauth_confirmationcode', 'digest')
+
+        # Adding field 'ConfirmationCode.code'
+        db.add_column(u'celauth_confirmationcode', 'code',
+                      self.gf('django.db.models.fields.CharField')(default='', unique=True, max_length=64),
+                      keep_default=False)
+
+
+    models = {
+        u'celauth.confirmationcode': {
+            'Meta': {'object_name': 'ConfirmationCode'},
+            'digest': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '40'}),
+            'email': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['celauth.EmailAddress']"}),
+            'expiration': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        u'celauth.emailaddress': {
+            'Meta': {'object_name': 'EmailAddress'},
+            'account': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            'address': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'primary_key': 'True'})
+        },
+        u'celauth.openid': {
+            'Meta': {'object_name': 'OpenID'},
+            'account': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            'claimed_id': ('django.db.models.fields.URLField', [], {'max_length': '255', 'primary_key': 'True'}),
+            'confirmed': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'display_id': ('django.db.models.fields.URLField', [], {'max_length': '255'}),
+            'email': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['celauth.EmailAddress']", 'null': 'True', 'blank': 'True'})
+        },
+        u'celauth.openidassociation': {
+            'Meta': {'object_name': 'OpenIDAssociation'},
+            'assoc_type': ('django.db.models.fields.TextField', [], {'max_length': '64'}),
+            'handle': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'issued': ('django.db.models.fields.IntegerField', [], {}),
+            'lifetime': ('django.db.models.fields.IntegerField', [], {}),
+            'secret': ('django.db.models.fields.TextField', [], {'max_length': '255'}),
+            'server_url': ('django.db.models.fields.URLField', [], {'max_length': '200', 'db_index': 'True'})
+        },
+        u'celauth.openidnonce': {
+            'Meta': {'unique_together': "(('server_url', 'timestamp', 'salt'),)", 'object_name': 'OpenIDNonce'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'salt': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'server_url': ('django.db.models.fields.URLField', [], {'max_length': '255'}),
+            'timestamp': ('django.db.models.fields.IntegerField', [], {'db_index': 'True'})
+        },
+        u'celauth.outboxemail': {
+            'Meta': {'object_name': 'OutboxEmail'},
+            'attempts': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'body': ('django.db.models.fields.TextField', [], {}),
+            'from_email': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'key': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '40'}),
+            'next_attempt': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            'recipient': ('django.db.models.fields.EmailField', [], {'max_length': '75'}),
+            'subject': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        u'celauth.ratebucket': {
+            'Meta': {'object_name': 'RateBucket'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'key': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '40'}),
+            'stamp': ('django.db.models.fields.FloatField', [], {}),
+            'tokens': ('django.db.models.fields.FloatField', [], {})
+        }
+    }
+
+    complete_apps = ['celauth']
\ No newline at end of file
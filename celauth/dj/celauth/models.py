@@ -1,12 +1,24 @@
 
+import heapq
+from collections import Counter
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from django.db import models
+from itertools import groupby
+from operator import itemgetter
+from django.db import models, transaction
+from django.db.models import Q
+from django.utils.crypto import salted_hmac
+
+CODE_LIFETIME = timedelta(hours=12)
 
 class OpenIDNonce(models.Model):
     server_url = models.URLField(max_length=255)
-    timestamp  = models.IntegerField()
+    timestamp  = models.IntegerField(db_index=True)
     salt       = models.CharField(max_length=40)
 
+    class Meta:
+        unique_together = ('server_url', 'timestamp', 'salt')
+
     def __unicode__(self):
         return u"OpenIDNonce: %i %s" % (self.timestamp, self.server_url)
 
@@ -42,35 +54,147 @@ class OpenID(models.Model):
     def __unicode__(self):
         return self.display_id
 
+def code_digest(code):
+    """Fixed width keyed digest of a confirmation code, as stored in the database.
+
+    With OutboxDelivery, the code is also in the body of its OutboxEmail in
+    plaintext, until the email is sent or given up on.
+    """
+    return salted_hmac('celauth.ConfirmationCode', code).hexdigest()
+
 class ConfirmationCode(models.Model):
     email = models.ForeignKey(EmailAddress)
-    code = models.CharField(unique=True, max_length=64)
-    expiration = models.DateTimeField()
+    digest = models.CharField(unique=True, max_length=40)
+    expiration = models.DateTimeField(db_index=True)
+
+class OutboxEmail(models.Model):
+    """Email queued for delivery by the celauth_send_outbox command.
+    The body has the confirmation code in plaintext.
+    """
+    key = models.CharField(unique=True, max_length=40) # for deduplication
+    from_email = models.CharField(max_length=255)
+    recipient = models.EmailField()
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(db_index=True)
+
+    def __unicode__(self):
+        return u"OutboxEmail: %s %s" % (self.recipient, self.subject)
+
+class RateBucket(models.Model):
+    """Token bucket state of a rate limited key"""
+    key = models.CharField(unique=True, max_length=40) # sha1 of rate limited key
+    tokens = models.FloatField()
+    stamp = models.FloatField()
+
+def _by_account(model, field, batch_size):
+    """(account, field) of rows having an account, ordered by both and read
+    a batch at a time, keyed on the last row of the previous batch
+    """
+    rows = model.objects.exclude(account=None).order_by('account', field)
+    last = None
+    while True:
+        batch = rows
+        if last:
+            batch = rows.filter(Q(account__gt=last[0]) |
+                                Q(account=last[0], **{field + '__gt': last[1]}))
+        batch = list(batch.values_list('account', field)[:batch_size])
+        for row in batch:
+            yield row
+        if len(batch) < batch_size:
+            return
+        last = batch[-1]
+
+def _for_update(queryset):
+    # row locks are only possible, and only needed, within a transaction
+    if transaction.get_connection().in_atomic_block:
+        return queryset.select_for_update()
+    return queryset
 
 class DjangoCelModelStore(object):
     def __init__(self, accountant):
         self._accountant = accountant
+        # by login pk, (latest instance, {changed field: instance changing it last})
+        # to save at the end of atomic()
+        self._dirty = None
+        self.saves = Counter() # login saves 'flushed' and saves 'coalesced' into them
+
+    @contextmanager
+    def atomic(self):
+        """One transaction, locking rows read for update and saving the changed
+        fields of each login once at the end
+        """
+        if self._dirty is not None:
+            yield
+            return
+        self._dirty = dict()
+        try:
+            with transaction.atomic():
+                yield
+                for openid, changes in self._dirty.values():
+                    for name, changed in changes.items():
+                        if changed is not openid:
+                            attname = OpenID._meta.get_field(name).attname
+                            setattr(openid, attname, getattr(changed, attname))
+                    openid.save(update_fields=changes.keys())
+                    self.saves['flushed'] += 1
+        finally:
+            self._dirty = None
+
+    def _save(self, openid, *fields):
+        if self._dirty is None:
+            openid.save(update_fields=fields)
+            self.saves['flushed'] += 1
+        else:
+            # instances of one row are saved once, with the latest change of each field
+            changes = self._dirty[openid.pk][1] if openid.pk in self._dirty else dict()
+            if changes:
+                self.saves['coalesced'] += 1
+            changes.update((name, openid) for name in fields)
+            self._dirty[openid.pk] = (openid, changes)
 
     def all_uris_by_account(self):
         """For testing"""
-        inverse = dict()
-        for openid in OpenID.objects.all():
-            if openid.account:
-                uris = inverse.setdefault(openid.account, set())
-                uris.add(openid.claimed_id)
-        for email in EmailAddress.objects.all():
-            if email.account:
-                uris = inverse.setdefault(email.account, set())
-                uris.add('mailto:' + email.address)
-        return set(map(frozenset,inverse.values()))
+        return set(frozenset(uris) for account, uris in self.account_groups())
+
+    def account_uris(self, batch_size=500):
+        """Stream of (account, uri) pairs ordered by account then uri, with
+        OpenID claimed_ids and mailto: URIs of email addresses
+        """
+        openids = _by_account(OpenID, 'claimed_id', batch_size)
+        addresses = (
+            (account, 'mailto:' + address)
+            for account, address in _by_account(EmailAddress, 'address', batch_size)
+        )
+        return heapq.merge(openids, addresses)
+
+    def account_groups(self, batch_size=500):
+        """Stream of (account, list of uris) pairs ordered by account"""
+        for account, pairs in groupby(self.account_uris(batch_size), itemgetter(0)):
+            yield account, [uri for a, uri in pairs]
     
     def loginids(self, account):
         return OpenID.objects.filter(account=account)
 
+    def account_logins(self, account):
+        openids = OpenID.objects.filter(account=account).select_related('email')
+        return [(o, o.address, o.confirmed) for o in openids]
+
     def get_login(self, loginid):
         assert loginid
         return loginid
 
+    def login_key(self, loginid):
+        return loginid.pk
+
+    def login_by_key(self, key):
+        key = getattr(key, 'pk', key) # sessions used to keep OpenID instances
+        try:
+            return OpenID.objects.select_related('email').get(pk=key)
+        except OpenID.DoesNotExist:
+            return None
+
     def account(self, loginid):
         return loginid.account if loginid else None
 
@@ -87,7 +211,7 @@ class DjangoCelModelStore(object):
         free.save()
 
     def note_openid(self, openid_case):
-        ret, new = OpenID.objects.get_or_create(
+        ret, new = _for_update(OpenID.objects).get_or_create(
                                     claimed_id = openid_case.claimed_id,
                                     display_id = openid_case.display_id)
         return ret
@@ -100,39 +224,71 @@ class DjangoCelModelStore(object):
         assert loginid
         email = self._get_email_address(email_address)
         loginid.email = email
-        loginid.save()
+        self._save(loginid, 'email')
 
     def save_confirmation_code(self, code, email_address):
-        expire = datetime.utcnow() + timedelta(hours=12)
+        expire = datetime.utcnow() + CODE_LIFETIME
         ConfirmationCode.objects.create(email=self._get_email_address(email_address),
-                                        code=code,
+                                        digest=code_digest(code),
                                         expiration=expire)
 
+    def recent_code(self, address, seconds):
+        # only digests of codes are kept, so a recent code is only known to be sent
+        sent_after = datetime.utcnow() - timedelta(seconds=seconds)
+        return ConfirmationCode.objects.filter(email__address=address,
+                                               expiration__gt=sent_after + CODE_LIFETIME
+                                               ).exists()
+
     def confirm_email(self, loginid, code):
-        try:
-            assert loginid
-            rec = ConfirmationCode.objects.get(code=code)
-            if datetime.utcnow() > rec.expiration:
-                return None
-            assert loginid.email == rec.email
-            if loginid.email == rec.email:
-                loginid.confirmed = True
-                loginid.save()
-                return loginid.email.address
-            else:
-                return None
-        except ConfirmationCode.DoesNotExist:
+        assert loginid
+        if not code:
+            return None
+        codes = ConfirmationCode.objects.filter(digest=code_digest(code),
+                                                expiration__gt=datetime.utcnow())
+        if loginid.email_id:
+            codes = codes.filter(email=loginid.email_id)
+        found = codes.values_list('email', flat=True)[:1]
+        if not found:
             return None
+        if not loginid.email_id:
+            loginid.email = EmailAddress.objects.get(pk=found[0])
+        loginid.confirmed = True
+        self._save(loginid, 'email', 'confirmed')
+        return found[0]
+
+    def confirm_address(self, loginid, address):
+        assert loginid
+        if loginid.email_id and loginid.email_id != address:
+            return None
+        if not loginid.email_id:
+            loginid.email = self._get_email_address(address)
+        loginid.confirmed = True
+        self._save(loginid, 'email', 'confirmed')
+        return address
 
     def assigned_account(self, address):
-        email = self._get_email_address(address)
-        if not email.account:
-            email.account = self._accountant.assigned_account(address)
-            email.save()
-        if email.account:
-            if OpenID.objects.filter(account=email.account).exists():
-                return None
-        return email.account
+        # account of address and whether any OpenID is attached in one query
+        has_openid = 'EXISTS (SELECT 1 FROM %s WHERE %s.account = %s.account)' % (
+            OpenID._meta.db_table, OpenID._meta.db_table, EmailAddress._meta.db_table)
+        found = EmailAddress.objects.filter(pk=address).extra(
+            select={'has_openid': has_openid}).values_list('account', 'has_openid')
+        if found and found[0][0]:
+            account, has_openid = found[0]
+            return None if has_openid else account
+        account = self._accountant.assigned_account(address)
+        if not account:
+            return None
+        created = False
+        if not found:
+            email, created = EmailAddress.objects.get_or_create(
+                pk=address, defaults={'account': account})
+        if not created and not EmailAddress.objects.filter(
+                pk=address, account=None).update(account=account):
+            # assigned concurrently, the first assignment stands
+            account = EmailAddress.objects.get(pk=address).account
+        if OpenID.objects.filter(account=account).exists():
+            return None
+        return account
 
     def add_address(self, account, address):
         email = self._get_email_address(address)
@@ -144,7 +300,7 @@ class DjangoCelModelStore(object):
 
     def set_account(self, loginid, account):
         loginid.account = account
-        loginid.save()
+        self._save(loginid, 'account')
 
     def create_account(self, loginid):
         assert loginid
@@ -155,10 +311,10 @@ class DjangoCelModelStore(object):
             return account
         openid = loginid
         openid.account = self._accountant.create_account(openid.address)
-        openid.save()
+        self._save(openid, 'account')
         return openid.account
 
     def _get_email_address(self, address):
-        ret, new = EmailAddress.objects.get_or_create(pk=address)
+        ret, new = _for_update(EmailAddress.objects).get_or_create(pk=address)
         return ret
 
@@ -30,102 +30,77 @@
 import base64
 import time
 
+from django.db import IntegrityError, transaction
 from openid.association import Association
 from openid.store.interface import OpenIDStore
 from openid.store.nonce import SKEW
 
 from celauth.dj.celauth.models import OpenIDAssociation, OpenIDNonce
+from celauth.dj.celauth.cache import association_cache
+from celauth.dj.celauth.sweep import delete_where, sweep_nonces, sweep_associations
 
 
 class DjangoOpenIDStore(OpenIDStore):
-    def __init__(self):
+    def __init__(self, cache=association_cache):
         self.max_nonce_age = 6 * 60 * 60 # Six hours
+        self._cache = cache
 
     def storeAssociation(self, server_url, association):
-        try:
-            assoc = OpenIDAssociation.objects.get(
-                server_url=server_url, handle=association.handle)
-        except OpenIDAssociation.DoesNotExist:
-            assoc = OpenIDAssociation(
-                server_url=server_url,
-                handle=association.handle,
-                secret=base64.encodestring(association.secret),
-                issued=association.issued,
-                lifetime=association.lifetime,
-                assoc_type=association.assoc_type)
-        else:
-            assoc.secret = base64.encodestring(association.secret)
-            assoc.issued = association.issued
-            assoc.lifetime = association.lifetime
-            assoc.assoc_type = association.assoc_type
-        assoc.save()
+        values = dict(
+            secret=base64.encodestring(association.secret),
+            issued=association.issued,
+            lifetime=association.lifetime,
+            assoc_type=association.assoc_type)
+        updated = OpenIDAssociation.objects.filter(
+            server_url=server_url, handle=association.handle).update(**values)
+        if not updated:
+            OpenIDAssociation.objects.create(
+                server_url=server_url, handle=association.handle, **values)
+        self._cache.invalidate(server_url, association.handle)
 
     def getAssociation(self, server_url, handle=None):
-        assocs = []
+        association = self._cache.get(server_url, handle)
+        if association is not None:
+            return association
+        delete_where(OpenIDAssociation, "server_url = %s AND issued + lifetime <= %s",
+                     [server_url, int(time.time())])
+        assocs = OpenIDAssociation.objects.filter(server_url=server_url)
         if handle is not None:
-            assocs = OpenIDAssociation.objects.filter(
-                server_url=server_url, handle=handle)
-        else:
-            assocs = OpenIDAssociation.objects.filter(server_url=server_url)
-        associations = []
-        expired = []
-        for assoc in assocs:
-            association = Association(
-                assoc.handle, base64.decodestring(assoc.secret), assoc.issued,
-                assoc.lifetime, assoc.assoc_type
-            )
-            if association.getExpiresIn() == 0:
-                expired.append(assoc)
-            else:
-                associations.append((association.issued, association))
-        for assoc in expired:
-            assoc.delete()
-        if not associations:
+            assocs = assocs.filter(handle=handle)
+        found = list(assocs.order_by('-issued')[:1])
+        if not found:
             return None
-        associations.sort()
-        return associations[-1][1]
+        latest = found[0]
+        association = Association(
+            latest.handle, base64.decodestring(latest.secret), latest.issued,
+            latest.lifetime, latest.assoc_type
+        )
+        self._cache.put(server_url, handle, association)
+        return association
 
     def removeAssociation(self, server_url, handle):
-        assocs = list(OpenIDAssociation.objects.filter(
-            server_url=server_url, handle=handle))
-        assocs_exist = len(assocs) > 0
-        for assoc in assocs:
-            assoc.delete()
-        return assocs_exist
+        removed = delete_where(OpenIDAssociation, "server_url = %s AND handle = %s",
+                               [server_url, handle])
+        self._cache.invalidate(server_url, handle)
+        return removed > 0
 
     def useNonce(self, server_url, timestamp, salt):
         if abs(timestamp - time.time()) > SKEW:
             return False
 
+        # unique constraint rejects a nonce already used
         try:
-            ononce = OpenIDNonce.objects.get(
-                server_url__exact=server_url,
-                timestamp__exact=timestamp,
-                salt__exact=salt)
-        except OpenIDNonce.DoesNotExist:
-            ononce = OpenIDNonce(
-                server_url=server_url,
-                timestamp=timestamp,
-                salt=salt)
-            ononce.save()
-            return True
-
-        return False
+            with transaction.atomic():
+                OpenIDNonce.objects.create(
+                    server_url=server_url,
+                    timestamp=timestamp,
+                    salt=salt)
+        except IntegrityError:
+            return False
+        return True
 
     def cleanupNonces(self, _now=None):
-        if _now is None:
-            _now = int(time.time())
-        expired = OpenIDNonce.objects.filter(timestamp__lt=_now - SKEW)
-        count = expired.count()
-        if count:
-            expired.delete()
-        return count
+        return sweep_nonces(_now).deleted
 
     def cleanupAssociations(self):
-        now = int(time.time())
-        expired = OpenIDAssociation.objects.extra(
-            where=['issued + lifetime < %d' % now])
-        count = expired.count()
-        if count:
-            expired.delete()
-        return count
+        return sweep_associations().deleted
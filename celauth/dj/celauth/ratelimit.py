@@ -0,0 +1,98 @@
+""" Bucket stores for celauth.core.TokenBuckets rate limits.
+"""
+
+from hashlib import sha1
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from celauth.core import TokenBuckets
+from celauth.dj.celauth.cache import _key
+from celauth.dj.celauth.models import RateBucket
+
+# burst of confirmation codes, and seconds until another code is allowed
+DEFAULT_CODE_RATE_LIMIT = (5, 15 * 60)
+
+class CacheBucketStore(object):
+    """Buckets approximated by counts of tokens taken per key and window of
+    capacity * refill_seconds, which cache increments keep atomic
+    """
+
+    def __init__(self, cache):
+        self._cache = cache
+
+    def _counter(self, key, capacity, refill_seconds, now):
+        window = capacity * refill_seconds
+        return _key('bucket', '%s:%i' % (key, now // window)), window
+
+    def take(self, key, capacity, refill_seconds, now):
+        counter, window = self._counter(key, capacity, refill_seconds, now)
+        self._cache.add(counter, 0, window)
+        try:
+            taken = self._cache.incr(counter)
+        except ValueError:
+            # expired since added
+            return self._cache.add(counter, 1, window)
+        return taken <= capacity
+
+    def give(self, key, capacity, refill_seconds, now):
+        counter, window = self._counter(key, capacity, refill_seconds, now)
+        try:
+            self._cache.decr(counter)
+        except ValueError:
+            pass
+
+def _hash(key):
+    return sha1(key.encode('utf-8')).hexdigest()
+
+class ModelBucketStore(object):
+    """Buckets in the RateBucket table, each take being one conditional UPDATE"""
+
+    def _take(self, hashed, capacity, refill_seconds, now):
+        qn = connection.ops.quote_name
+        tokens, stamp = qn('tokens'), qn('stamp')
+        refilled = "(%s + (%%s - %s) / %%s)" % (tokens, stamp)
+        sql = ("UPDATE %s SET %s = (CASE WHEN %s > %%s THEN %%s ELSE %s END) - 1, %s = %%s"
+               " WHERE %s = %%s AND %s >= 1" % (qn(RateBucket._meta.db_table), tokens,
+                                                refilled, refilled, stamp, qn('key'), refilled))
+        cursor = connection.cursor()
+        cursor.execute(sql, [now, refill_seconds, capacity, capacity, now, refill_seconds,
+                             now, hashed, now, refill_seconds])
+        return cursor.rowcount > 0
+
+    def take(self, key, capacity, refill_seconds, now):
+        hashed = _hash(key)
+        if self._take(hashed, capacity, refill_seconds, now):
+            return True
+        # no bucket yet, or no token in it
+        try:
+            with transaction.atomic():
+                RateBucket.objects.create(key=hashed, tokens=capacity - 1, stamp=now)
+            return True
+        except IntegrityError:
+            pass
+        # bucket made concurrently
+        return self._take(hashed, capacity, refill_seconds, now)
+
+    def give(self, key, capacity, refill_seconds, now):
+        RateBucket.objects.filter(key=_hash(key)).update(tokens=F('tokens') + 1)
+
+def code_rate_limit():
+    """(burst, seconds per code) of settings.CEL_CODE_RATE_LIMIT, or None for no limit"""
+    return getattr(settings, 'CEL_CODE_RATE_LIMIT', DEFAULT_CODE_RATE_LIMIT)
+
+def code_limiter():
+    """Confirmation code rate limit configured by settings.
+
+    CEL_CODE_RATE_LIMIT is a (burst, seconds per code) pair, or None for no limit.
+    Bucket state is kept in the cache named by CEL_CODE_RATE_CACHE, by default
+    'default', or in the database if CEL_CODE_RATE_CACHE is None. A cache not
+    shared by all processes, such as the default LocMemCache, limits per process.
+    """
+    rate = code_rate_limit()
+    if not rate:
+        return None
+    alias = getattr(settings, 'CEL_CODE_RATE_CACHE', 'default')
+    store = CacheBucketStore(get_cache(alias)) if alias else ModelBucketStore()
+    capacity, refill_seconds = rate
+    return TokenBuckets(store, capacity, refill_seconds)
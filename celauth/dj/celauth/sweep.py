@@ -0,0 +1,100 @@
+""" Deletion of expired confirmation codes, OpenID nonces and OpenID associations,
+of outbox emails given up on and of refilled rate limit buckets.
+
+Rows are deleted in batches of primary keys, each batch in its own short
+statement that rechecks expiration, so sweeping can run alongside logins.
+"""
+
+import time
+from collections import namedtuple
+from datetime import datetime
+from django.db import connection
+from openid.store.nonce import SKEW
+from celauth.dj.celauth.models import ConfirmationCode, OpenIDNonce, OpenIDAssociation
+from celauth.dj.celauth.models import OutboxEmail, RateBucket
+from celauth.dj.celauth.delivery import MAX_ATTEMPTS
+from celauth.dj.celauth.ratelimit import code_rate_limit
+
+DEFAULT_BATCH_SIZE = 500
+
+class SweepResult(namedtuple('SweepResult', ['table', 'deleted', 'batches', 'seconds'])):
+    @property
+    def rows_per_second(self):
+        return self.deleted / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return "%s: %i rows deleted in %i batches, %.1f rows/s" % (
+            self.table, self.deleted, self.batches, self.rows_per_second)
+
+def delete_where(model, where, params):
+    """Delete rows of model matching SQL where clause in one statement.
+    Returns number of rows deleted.
+    """
+    table = connection.ops.quote_name(model._meta.db_table)
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM %s WHERE %s" % (table, where), params)
+    return cursor.rowcount
+
+def _sweep(model, where, params, batch_size):
+    start = time.time()
+    pk_column = connection.ops.quote_name(model._meta.pk.column)
+    deleted = 0
+    batches = 0
+    last_pk = None
+    while True:
+        expired = model.objects.extra(where=[where], params=params).order_by('pk')
+        if last_pk is not None:
+            expired = expired.filter(pk__gt=last_pk)
+        pks = list(expired.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            break
+        last_pk = pks[-1]
+        in_batch = "%s IN (%s) AND %s" % (pk_column, ", ".join(["%s"] * len(pks)), where)
+        deleted += delete_where(model, in_batch, pks + params)
+        batches += 1
+        if len(pks) < batch_size:
+            break
+    return SweepResult(model._meta.db_table, deleted, batches, time.time() - start)
+
+def sweep_confirmation_codes(now=None, batch_size=DEFAULT_BATCH_SIZE):
+    if now is None:
+        now = datetime.utcnow()
+    return _sweep(ConfirmationCode, "expiration < %s", [now], batch_size)
+
+def sweep_nonces(now=None, batch_size=DEFAULT_BATCH_SIZE):
+    if now is None:
+        now = int(time.time())
+    where = "%s < %%s" % connection.ops.quote_name('timestamp')
+    return _sweep(OpenIDNonce, where, [now - SKEW], batch_size)
+
+def sweep_associations(now=None, batch_size=DEFAULT_BATCH_SIZE):
+    if now is None:
+        now = int(time.time())
+    return _sweep(OpenIDAssociation, "issued + lifetime < %s", [now], batch_size)
+
+def sweep_dead_outbox(now=None, max_attempts=MAX_ATTEMPTS, batch_size=DEFAULT_BATCH_SIZE):
+    """Delete outbox emails out of attempts, such as those left by a drain
+    that stopped during their last attempt, once their lease has passed.
+    """
+    if now is None:
+        now = datetime.utcnow()
+    where = "attempts >= %s AND next_attempt < %s"
+    return _sweep(OutboxEmail, where, [max_attempts, now], batch_size)
+
+def sweep_rate_buckets(now=None, batch_size=DEFAULT_BATCH_SIZE):
+    """Delete rate limit buckets full again, which are as good as no bucket"""
+    if now is None:
+        now = time.time()
+    rate = code_rate_limit()
+    full_seconds = rate[0] * rate[1] if rate else 0
+    return _sweep(RateBucket, "stamp < %s", [now - full_seconds], batch_size)
+
+def sweep_expired(batch_size=DEFAULT_BATCH_SIZE):
+    """Delete all expired rows, returning a SweepResult per table"""
+    return [
+        sweep_confirmation_codes(batch_size=batch_size),
+        sweep_nonces(batch_size=batch_size),
+        sweep_associations(batch_size=batch_size),
+        sweep_dead_outbox(batch_size=batch_size),
+        sweep_rate_buckets(batch_size=batch_size),
+    ]
@@ -0,0 +1,11 @@
+from django import template
+from celauth.dj.celauth import provider_buttons_html
+
+register = template.Library()
+
+@register.simple_tag
+def provider_buttons(choices, openid_url_field=None):
+    """Provider buttons of choices, with one for any OpenID unless there is
+    an OpenID URL field
+    """
+    return provider_buttons_html(choices, not openid_url_field)
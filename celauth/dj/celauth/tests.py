@@ -1,14 +1,54 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from StringIO import StringIO
+from datetime import datetime, timedelta
 from django.utils import unittest
+from django.utils.importlib import import_module
 from django.utils.module_loading import import_by_path
 from django.conf import settings
-from django.test import TestCase, TransactionTestCase
-from django.test.client import Client
+from django.test import TestCase, TransactionTestCase, skipUnlessDBFeature
+from django.test.client import Client, RequestFactory
+from django.test.utils import override_settings, CaptureQueriesContext
 from django.core.urlresolvers import reverse
 from django.core import mail
-from celauth.tests import CelTestCase, FakeMailer, TestSessionStore
+from django.core.management import call_command
+from django.core.mail import EmailMessage
+from django.core.mail.backends import locmem
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.cache import get_cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.db.models.query import QuerySet
+from openid import fetchers
+from openid.association import Association
+from openid.consumer.discover import DiscoveryFailure
+from celauth.tests import CelTestCase, FakeMailer, TestSessionStore, openid
+from celauth.tests import take_code_from_email, code_in_email
 from celauth import providers
-from celauth.core import make_auth_gate
-from celauth.dj.celauth.models import DjangoCelModelStore
+from celauth.core import make_auth_gate, TokenBuckets, SignedCodes, InvalidConfirmationCode
+from celauth.core import AccountConflict
+from celauth.dj.celauth import Mailer, DjangoCelSessionStore, provider_buttons_html
+from celauth.session import CelSession
+from celauth.dj.celauth.models import DjangoCelModelStore, EmailAddress, ConfirmationCode, OpenID
+from celauth.dj.celauth.models import OpenIDNonce, OpenIDAssociation, code_digest
+from celauth.dj.celauth.models import _for_update
+from celauth.dj.celauth.sweep import sweep_expired
+from celauth.dj.celauth.openid_store import DjangoOpenIDStore
+from celauth.dj.celauth.cache import CachedCelRegistryStore, AssociationCache, association_cache
+from celauth.dj.celauth.benchmarks import run_login_flow, time_mailer, _message_uncached
+from celauth.dj.celauth.benchmarks import time_auth_gate
+from celauth.dj.celauth.views import AuthGateFactory, get_auth_gate
+from celauth.dj.celauth.delivery import ThreadPoolDelivery, BatchingDelivery
+from celauth.dj.celauth.delivery import OutboxDelivery, drain_outbox, MAX_ATTEMPTS
+from celauth.dj.celauth.models import OutboxEmail, RateBucket
+from celauth.dj.celauth.ratelimit import CacheBucketStore, ModelBucketStore
+from celauth.dj.celauth.ratelimit import DEFAULT_CODE_RATE_LIMIT
+from celauth.dj.celauth.codes import CacheReplaySet, signed_codes
+from celauth.dj.celauth.bulk import import_records, read_csv, read_json_lines
+from celauth.dj.celauth.bulk import export_json_lines
 
 providers.enable_test_openids()
 
@@ -22,6 +62,205 @@ class DjModelStoreTestCase(TransactionTestCase, CelTestCase):
         self.store = None
         self.gate = None
 
+    def test_assigned_account_queries(self):
+        account = self.store.create_account('mailto:joe@example.com')
+        with self.assertNumQueries(1):
+            self.assertEqual(self.store.assigned_account('joe@example.com'), account)
+        loginid = self.store.note_openid(openid('com', 'joe'))
+        self.store.set_account(loginid, account)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.store.assigned_account('joe@example.com'), None)
+
+    def test_login_conflict_rolled_back(self):
+        for name in ['a', 'b']:
+            loginid = self.store.note_openid(openid('com', name))
+            self.store.set_address(loginid, '%s@example.com' % name)
+            self.store.create_account(loginid)
+        self.gate.login(openid('com', 'a'))
+        self.assertRaises(AccountConflict, self.gate.login,
+                          openid('com', 'b', 'new@example.com'))
+        self.assertFalse(EmailAddress.objects.filter(pk='new@example.com').exists())
+        self.assertEqual(OpenID.objects.get(pk=openid('com', 'b').claimed_id).address,
+                         'b@example.com')
+
+    def test_confirm_saves_coalesced(self):
+        account = self.store.create_account('mailto:joe@example.com')
+        self.gate.login(openid('com', 'joe'))
+        flushed = self.store.saves['flushed']
+        coalesced = self.store.saves['coalesced']
+        self.gate.confirm_email(take_code_from_email())
+        self.assertEqual(self.gate.account, account)
+        self.assertEqual(self.store.saves['flushed'], flushed + 1)
+        self.assertEqual(self.store.saves['coalesced'], coalesced + 1)
+
+    def test_saves_coalesced_by_row(self):
+        account = self.store.create_account('mailto:sue@example.com')
+        loginid = self.store.note_openid(openid('com', 'joe'))
+        flushed = self.store.saves['flushed']
+        with CaptureQueriesContext(connection) as queries:
+            with self.store.atomic():
+                one = OpenID.objects.get(pk=loginid.pk)
+                other = OpenID.objects.get(pk=loginid.pk)
+                self.store.set_address(one, 'joe@example.com')
+                self.store.set_account(other, account)
+        updates = [q for q in queries if 'UPDATE "celauth_openid"' in q['sql']]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(self.store.saves['flushed'], flushed + 1)
+        saved = OpenID.objects.get(pk=loginid.pk)
+        self.assertEqual((saved.email_id, saved.account), ('joe@example.com', account))
+
+    def test_code_digests(self):
+        loginid = self.store.note_openid(openid('com', 'joe'))
+        self.store.save_confirmation_code('SECRET12', 'joe@example.com')
+        self.assertEqual([c.digest for c in ConfirmationCode.objects.all()],
+                         [code_digest('SECRET12')])
+        ConfirmationCode.objects.update(expiration=datetime.utcnow() - timedelta(hours=1))
+        with self.assertNumQueries(1):
+            self.assertEqual(self.store.confirm_email(loginid, 'SECRET12'), None)
+
+    def test_recent_code_not_replaced(self):
+        gate = make_auth_gate(self.store, FakeMailer(), TestSessionStore())
+        gate.login(openid('com', 'joe'))
+        gate.claim('joe@example.com')
+        code = take_code_from_email()
+        gate.claim('joe@example.com')
+        self.assertFalse(code_in_email()) # code already sent is still valid
+        self.assertEqual(ConfirmationCode.objects.count(), 1)
+        ConfirmationCode.objects.update(expiration=datetime.utcnow() + timedelta(hours=1))
+        gate.claim('joe@example.com')
+        self.assertNotEqual(take_code_from_email(), code)
+        self.assertEqual(ConfirmationCode.objects.count(), 2)
+
+class SignedCodesDjModelStoreTestCase(DjModelStoreTestCase):
+    def setUp(self):
+        AccountManager = import_by_path(settings.CEL_ACCOUNTANT)
+        cache = get_cache('django.core.cache.backends.locmem.LocMemCache',
+                          LOCATION='celauth-tests')
+        cache.clear()
+        self.store = DjangoCelModelStore(AccountManager())
+        signed_codes = SignedCodes(settings.SECRET_KEY, CacheReplaySet(cache))
+        self.gate = make_auth_gate(self.store, FakeMailer(), TestSessionStore(),
+                                   signed_codes=signed_codes)
+
+    def test_codes_not_stored(self):
+        loginid = openid('com', 'joe')
+        self.gate.login(loginid)
+        self.gate.claim('joe@example.com')
+        code = take_code_from_email()
+        self.assertFalse(ConfirmationCode.objects.exists())
+        self.gate.confirm_email(code)
+        self.assertEqual(self.gate.addresses_confirmed(), ['joe@example.com'])
+        self.gate.logout()
+        self.gate.login(openid('org', 'joe', 'joe@example.com'))
+        self.assertRaises(InvalidConfirmationCode, self.gate.confirm_email, code)
+        take_code_from_email()
+
+class ConcurrentLoginTest(TransactionTestCase):
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_parallel_logins(self):
+        AccountManager = import_by_path(settings.CEL_ACCOUNTANT)
+        start = threading.Event()
+        errors = []
+        def login(name):
+            try:
+                gate = make_auth_gate(DjangoCelModelStore(AccountManager()),
+                                      FakeMailer(), TestSessionStore())
+                start.wait()
+                gate.login(openid('com', name, 'joe@example.com'))
+            except Exception as ex:
+                errors.append(ex)
+            finally:
+                connection.close()
+        threads = [threading.Thread(target=login, args=('joe%i' % i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        take_code_from_email()
+        self.assertEqual(errors, [])
+        self.assertEqual(EmailAddress.objects.filter(pk='joe@example.com').count(), 1)
+        self.assertEqual(OpenID.objects.filter(email='joe@example.com').count(), 8)
+
+class LoginLockingTest(TransactionTestCase):
+    """Runs on databases without row locks too, such as sqlite"""
+
+    def test_login_locks_rows(self):
+        AccountManager = import_by_path(settings.CEL_ACCOUNTANT)
+        locked = []
+        select_for_update = QuerySet.select_for_update
+        def recording(queryset, *args, **kwargs):
+            locked.append(queryset.model)
+            return select_for_update(queryset, *args, **kwargs)
+        QuerySet.select_for_update = recording
+        try:
+            for name in ['joe1', 'joe2']:
+                gate = make_auth_gate(DjangoCelModelStore(AccountManager()),
+                                      FakeMailer(), TestSessionStore())
+                with CaptureQueriesContext(connection) as queries:
+                    gate.login(openid('com', name, 'joe@example.com'))
+                take_code_from_email()
+        finally:
+            QuerySet.select_for_update = select_for_update
+        self.assertEqual(locked, [OpenID, EmailAddress] * 2)
+        if connection.features.has_select_for_update:
+            self.assertTrue(any('FOR UPDATE' in q['sql'] for q in queries))
+        self.assertEqual(EmailAddress.objects.filter(pk='joe@example.com').count(), 1)
+        self.assertEqual(sorted(OpenID.objects.filter(email='joe@example.com')
+                                              .values_list('pk', flat=True)),
+                         [openid('com', 'joe1').claimed_id, openid('com', 'joe2').claimed_id])
+
+    def test_locks_only_within_transaction(self):
+        self.assertFalse(_for_update(OpenID.objects.all()).query.select_for_update)
+        with transaction.atomic():
+            self.assertTrue(_for_update(OpenID.objects.all()).query.select_for_update)
+
+class CachedDjModelStoreTestCase(DjModelStoreTestCase):
+    def setUp(self):
+        AccountManager = import_by_path(settings.CEL_ACCOUNTANT)
+        cache = get_cache('django.core.cache.backends.locmem.LocMemCache',
+                          LOCATION='celauth-tests')
+        cache.clear()
+        self.store = CachedCelRegistryStore(DjangoCelModelStore(AccountManager()), cache)
+        self.gate = make_auth_gate(self.store, FakeMailer(), TestSessionStore())
+
+    def test_cache_hits(self):
+        self.assertTrue(self.store.is_free_address('joe@example.com'))
+        self.assertTrue(self.store.is_free_address('joe@example.com'))
+        self.assertEqual(self.store.misses['is_free_address'], 1)
+        self.assertEqual(self.store.hits['is_free_address'], 1)
+        account = self.store.create_account('mailto:joe@example.com')
+        self.assertFalse(self.store.is_free_address('joe@example.com'))
+        self.assertEqual(self.store.misses['is_free_address'], 2)
+        self.assertEqual(self.store.assigned_account('joe@example.com'), account)
+        self.assertEqual(self.store.assigned_account('joe@example.com'), account)
+        self.assertEqual(self.store.hits['assigned_account'], 1)
+        loginid = self.store.note_openid(openid('com', 'joe'))
+        self.store.set_account(loginid, account)
+        self.assertEqual(self.store.assigned_account('joe@example.com'), None)
+        self.assertEqual(self.store.misses['assigned_account'], 2)
+
+    def test_invalidated_after_commit(self):
+        account = self.store.create_account('mailto:joe@example.com')
+        other = CachedCelRegistryStore(self.store._store, self.store._cache)
+        self.assertTrue(other.is_free_address('sue@example.com'))
+        with self.store.atomic():
+            self.store.add_address(account, 'sue@example.com')
+            self.assertFalse(self.store.is_free_address('sue@example.com'))
+            self.assertTrue(other.is_free_address('sue@example.com'))
+        self.assertFalse(other.is_free_address('sue@example.com'))
+        self.assertEqual(other.misses['is_free_address'], 2)
+
+    def test_rollback_keeps_entries(self):
+        account = self.store.create_account('mailto:joe@example.com')
+        self.assertTrue(self.store.is_free_address('sue@example.com'))
+        with self.assertRaises(ValueError):
+            with self.store.atomic():
+                self.store.add_address(account, 'sue@example.com')
+                raise ValueError
+        self.assertTrue(self.store.is_free_address('sue@example.com'))
+        self.assertEqual(self.store.hits['is_free_address'], 1)
+
 class CelDjTestCase(TestCase):
     def login_as(self, tld, id, email_id, next_url=None):
         openid = 'https://example.%s/%s' % (tld, id)
@@ -104,3 +343,554 @@ class ExistingAccountTests(CelDjTestCase):
             response = self.login_as('com', 'myid2', 'mybox', final_url)
             self.assertRedirects(response, final_url, target_status_code=404)
 
+class SessionStoreTest(TestCase):
+    def test_saved_once(self):
+        request = RequestFactory().get('/')
+        request.session = import_module(settings.SESSION_ENGINE).SessionStore()
+        store = DjangoCelSessionStore(request)
+        session = CelSession(store)
+        with self.assertNumQueries(0):
+            session.loginid = 'https://example.com/joe'
+            session.clear()
+        self.assertTrue(request.session.modified)
+        store.flush()
+        saved = import_module(settings.SESSION_ENGINE).SessionStore(request.session.session_key)
+        self.assertEqual(saved['authgate'], {'loginid': None, 'account': None})
+
+    def test_primitive_loginid(self):
+        AccountManager = import_by_path(settings.CEL_ACCOUNTANT)
+        request = RequestFactory().get('/')
+        request.session = import_module(settings.SESSION_ENGINE).SessionStore()
+        def auth_gate():
+            return make_auth_gate(DjangoCelModelStore(AccountManager()), FakeMailer(),
+                                  DjangoCelSessionStore(request))
+        auth_gate().login(openid('com', 'joe'))
+        take_code_from_email()
+        vals = json.loads(json.dumps(request.session['authgate']))
+        self.assertEqual(vals, {'loginid': 'https://example.com/joe', 'account': None})
+        gate = auth_gate()
+        with self.assertNumQueries(1):
+            self.assertEqual(gate.loginid.address, 'joe@example.com')
+            self.assertEqual(gate.loginid.address, 'joe@example.com')
+
+SIGNED_CODES_CACHES = dict(settings.CACHES, signed_codes={
+    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    'LOCATION': os.path.join(tempfile.gettempdir(), 'celauth-tests-signed-codes'),
+})
+SIGNED_CODES_SETTINGS = dict(CEL_SIGNED_CODES=True, CEL_SIGNED_CODES_CACHE='signed_codes',
+                             CACHES=SIGNED_CODES_CACHES)
+
+class SignedCodesSettingsTest(TestCase):
+    def test_shared_cache_required(self):
+        with override_settings(CEL_SIGNED_CODES=True):
+            self.assertRaises(ImproperlyConfigured, signed_codes)
+        with override_settings(CEL_SIGNED_CODES=True, CEL_SIGNED_CODES_CACHE='default'):
+            self.assertRaises(ImproperlyConfigured, signed_codes)
+        with override_settings(**SIGNED_CODES_SETTINGS):
+            self.assertTrue(signed_codes())
+
+class AuthGateFactoryTest(TestCase):
+    def test_gate_per_request(self):
+        request = RequestFactory().get('/', HTTP_HOST='testserver')
+        gate = get_auth_gate(request)
+        self.assertIs(get_auth_gate(request), gate)
+        self.assertIsNot(get_auth_gate(RequestFactory().get('/')), gate)
+        with override_settings(**SIGNED_CODES_SETTINGS):
+            self.assertTrue(get_auth_gate(RequestFactory().get('/'))._registry._signed_codes)
+        self.assertFalse(get_auth_gate(RequestFactory().get('/'))._registry._signed_codes)
+
+    @override_settings(CEL_REGISTRY_CACHE='default')
+    def test_registry_cache_per_thread(self):
+        factory = AuthGateFactory()
+        stores = [factory(RequestFactory().get('/'))._registry._store for i in range(2)]
+        self.assertIsNot(stores[0], stores[1])
+        self.assertIs(stores[0]._cache, stores[1]._cache)
+
+    def test_time_auth_gate(self):
+        timing = time_auth_gate(10)
+        self.assertTrue(timing['settings_per_call'] > 0 and timing['factory'] > 0)
+        self.assertTrue(timing['memoized'] < timing['settings_per_call'])
+
+class LoginFlowBenchmarkTest(TestCase):
+    def test_login_flow(self):
+        report = run_login_flow(self.client)
+        path = os.environ.get('CELAUTH_BENCHMARK_REPORT', None)
+        if path:
+            with open(path, 'w') as out:
+                out.write(report.as_json())
+        self.assertEqual(report.regressions(), [])
+
+    @override_settings(**SIGNED_CODES_SETTINGS)
+    def test_login_flow_signed_codes(self):
+        report = run_login_flow(self.client)
+        self.assertEqual(report.regressions(), [])
+        self.assertFalse(ConfirmationCode.objects.exists())
+
+class LoginFlowAutocommitBenchmarkTest(TransactionTestCase):
+    def test_login_flow(self):
+        # same counts as within the transaction of a TestCase
+        report = run_login_flow(self.client)
+        self.assertEqual(report.regressions(), [])
+        self.assertTrue(all(s['max_queries'] for s in report.steps))
+
+class StubAccountant(object):
+    def __init__(self, accounts):
+        self.accounts = accounts
+        self.asked = []
+
+    def assigned_account(self, address):
+        self.asked.append(address)
+        return self.accounts.get(address, None)
+
+class BulkStubAccountant(StubAccountant):
+    def assigned_accounts(self, addresses):
+        self.asked.append(sorted(addresses))
+        return dict((a, self.accounts[a]) for a in addresses if a in self.accounts)
+
+class RacingAccountant(StubAccountant):
+    def assigned_account(self, address):
+        # another request assigns the address meanwhile
+        EmailAddress.objects.create(address=address, account=9)
+        return super(RacingAccountant, self).assigned_account(address)
+
+class AssignedAccountRaceTest(TestCase):
+    def test_concurrent_assignment_stands(self):
+        store = DjangoCelModelStore(RacingAccountant({'joe@example.com': 5}))
+        self.assertEqual(store.assigned_account('joe@example.com'), 9)
+        self.assertEqual(EmailAddress.objects.get(pk='joe@example.com').account, 9)
+
+class BulkImportTest(TestCase):
+    def test_import_records(self):
+        EmailAddress.objects.create(address='old@example.com', account=3)
+        OpenID.objects.create(claimed_id='https://example.com/old', display_id='old')
+        records = [
+            {'address': 'joe@EXAMPLE.com', 'claimed_id': 'https://example.com/joe'},
+            {'address': 'joe@example.com', 'claimed_id': 'https://example.org/joe',
+             'confirmed': 'yes'},
+            {'address': 'jim@example.com', 'account': '5'},
+            {'address': 'old@example.com', 'claimed_id': 'https://example.com/old'},
+            {'address': ''},
+        ]
+        accountant = BulkStubAccountant({'joe@example.com': 4, 'old@example.com': 6})
+        result = import_records(records, accountant, batch_size=3)
+        self.assertEqual(result[:4], (5, 2, 2, 2))
+        self.assertEqual(accountant.asked, [['joe@example.com']])
+        self.assertEqual(dict(EmailAddress.objects.values_list('address', 'account')),
+                         {'joe@example.com': 4, 'jim@example.com': 5, 'old@example.com': 3})
+        openids = OpenID.objects.filter(email='joe@example.com').order_by('pk')
+        self.assertEqual([(o.account, o.confirmed) for o in openids], [(4, False), (4, True)])
+        self.assertEqual(OpenID.objects.get(pk='https://example.com/old').email, None)
+
+    def test_queries_per_chunk(self):
+        records = [{'address': 'user%i@example.com' % i,
+                    'claimed_id': 'https://example.com/user%i' % i} for i in range(400)]
+        accountant = StubAccountant(dict())
+        with CaptureQueriesContext(connection) as queries:
+            result = import_records(iter(records), accountant, batch_size=200)
+        self.assertEqual(result.openids, 400)
+        self.assertEqual(len(accountant.asked), 400)
+        self.assertTrue(len(queries) < 20)
+
+    @override_settings(CEL_REGISTRY_CACHE='default')
+    def test_cached_entries_dropped(self):
+        cache = get_cache('default')
+        cache.clear()
+        store = CachedCelRegistryStore(DjangoCelModelStore(StubAccountant(dict())), cache)
+        self.assertTrue(store.is_free_address('joe@example.com'))
+        self.assertEqual(store.assigned_account('joe@example.com'), None)
+        import_records([{'address': 'joe@example.com', 'account': '4'}], StubAccountant(dict()))
+        self.assertFalse(store.is_free_address('joe@example.com'))
+        self.assertEqual(store.assigned_account('joe@example.com'), 4)
+        self.assertEqual(store.misses['is_free_address'], 2)
+
+    def test_readers_and_command(self):
+        csv_lines = StringIO("address,claimed_id\njoe@example.com,https://example.com/joe\n")
+        self.assertEqual(list(read_csv(csv_lines)),
+                         [{'address': 'joe@example.com', 'claimed_id': 'https://example.com/joe'}])
+        json_lines = StringIO('{"address": "jim@example.com"}\n\n{"address": "jo@example.com"}\n')
+        self.assertEqual([r['address'] for r in read_json_lines(json_lines)],
+                         ['jim@example.com', 'jo@example.com'])
+        with tempfile.NamedTemporaryFile(suffix='.csv') as f:
+            f.write("address,claimed_id\njoe@example.com,https://example.com/joe\n")
+            f.flush()
+            out = StringIO()
+            call_command('celauth_import', f.name, stdout=out)
+        self.assertIn('1 rows imported', out.getvalue())
+        self.assertEqual(OpenID.objects.get().address, 'joe@example.com')
+
+class BulkExportTest(TestCase):
+    def setUp(self):
+        for account, name in [(2, 'joe'), (1, 'ann'), (2, 'jim'), (None, 'eve'), (3, 'bob')]:
+            email = EmailAddress.objects.create(address='%s@example.com' % name,
+                                                account=account)
+            OpenID.objects.create(claimed_id='https://example.com/' + name, display_id=name,
+                                  email=email, account=account if name != 'bob' else None)
+        self.store = DjangoCelModelStore(StubAccountant(dict()))
+
+    def test_account_uris(self):
+        with self.assertNumQueries(5): # 3 OpenID and 4 EmailAddress rows, 2 per query
+            pairs = list(self.store.account_uris(batch_size=2))
+        self.assertEqual(pairs, [
+            (1, 'https://example.com/ann'),
+            (1, 'mailto:ann@example.com'),
+            (2, 'https://example.com/jim'),
+            (2, 'https://example.com/joe'),
+            (2, 'mailto:jim@example.com'),
+            (2, 'mailto:joe@example.com'),
+            (3, 'mailto:bob@example.com'),
+        ])
+        groups = list(self.store.account_groups(batch_size=2))
+        self.assertEqual([(a, len(uris)) for a, uris in groups], [(1, 2), (2, 4), (3, 1)])
+        self.assertEqual(len(self.store.all_uris_by_account()), 3)
+
+    def test_json_lines(self):
+        out = StringIO()
+        self.assertEqual(export_json_lines(self.store, out, group=True), 3)
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(lines[0], {'account': 1, 'uris': ['https://example.com/ann',
+                                                            'mailto:ann@example.com']})
+        out = StringIO()
+        call_command('celauth_export', stdout=out)
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(lines[-1], {'account': 3, 'uri': 'mailto:bob@example.com'})
+
+class SweepTest(TestCase):
+    def test_sweep_expired(self):
+        email = EmailAddress.objects.create(address='joe@example.com')
+        now = datetime.utcnow()
+        for i in range(5):
+            ConfirmationCode.objects.create(email=email, digest=code_digest('OLD%i' % i),
+                                            expiration=now - timedelta(hours=1))
+        ConfirmationCode.objects.create(email=email, digest=code_digest('NEW'),
+                                        expiration=now + timedelta(hours=1))
+        stamp = int(time.time())
+        for i in range(3):
+            OpenIDNonce.objects.create(server_url='https://example.com/',
+                                       timestamp=stamp - 24*60*60, salt='old%i' % i)
+        OpenIDNonce.objects.create(server_url='https://example.com/',
+                                   timestamp=stamp, salt='new')
+        OpenIDAssociation.objects.create(server_url='https://example.com/', handle='old',
+                                         secret='', issued=stamp - 100, lifetime=10,
+                                         assoc_type='HMAC-SHA1')
+        OpenIDAssociation.objects.create(server_url='https://example.com/', handle='new',
+                                         secret='', issued=stamp, lifetime=100,
+                                         assoc_type='HMAC-SHA1')
+        for attempts in [MAX_ATTEMPTS, MAX_ATTEMPTS - 1]:
+            OutboxEmail.objects.create(key='%i' % attempts, from_email='noreply@example.com',
+                                       recipient='joe@example.com', subject='', body='',
+                                       attempts=attempts, next_attempt=now)
+        capacity, refill_seconds = DEFAULT_CODE_RATE_LIMIT
+        for key, stamp in [('old', stamp - capacity * refill_seconds - 1), ('new', stamp)]:
+            RateBucket.objects.create(key=key, tokens=0, stamp=stamp)
+        results = sweep_expired(batch_size=2)
+        self.assertEqual([(r.deleted, r.batches) for r in results],
+                         [(5, 3), (3, 2), (1, 1), (1, 1), (1, 1)])
+        self.assertEqual([c.digest for c in ConfirmationCode.objects.all()],
+                         [code_digest('NEW')])
+        self.assertEqual([n.salt for n in OpenIDNonce.objects.all()], ['new'])
+        self.assertEqual([a.handle for a in OpenIDAssociation.objects.all()], ['new'])
+        self.assertEqual([e.attempts for e in OutboxEmail.objects.all()], [MAX_ATTEMPTS - 1])
+        self.assertEqual([b.key for b in RateBucket.objects.all()], ['new'])
+
+class OpenIDStoreTest(TestCase):
+    def setUp(self):
+        association_cache.clear()
+
+    def test_nonce_used_once(self):
+        store = DjangoOpenIDStore()
+        stamp = int(time.time())
+        self.assertTrue(store.useNonce('https://example.com/', stamp, 'salt'))
+        self.assertFalse(store.useNonce('https://example.com/', stamp, 'salt'))
+        self.assertTrue(store.useNonce('https://example.com/', stamp, 'pepper'))
+        self.assertFalse(store.useNonce('https://example.com/', stamp - 24*60*60, 'salt'))
+
+    def test_association_queries(self):
+        store = DjangoOpenIDStore()
+        url = 'https://example.com/'
+        stamp = int(time.time())
+        for i in range(5):
+            store.storeAssociation(url, Association('old%i' % i, 'secret', stamp - 100, 10, 'HMAC-SHA1'))
+        with self.assertNumQueries(1):
+            store.storeAssociation(url, Association('old0', 'secret', stamp - 100, 10, 'HMAC-SHA1'))
+        store.storeAssociation(url, Association('new', 'secret', stamp, 100, 'HMAC-SHA1'))
+        store.storeAssociation(url, Association('newer', 'secret', stamp + 1, 100, 'HMAC-SHA1'))
+        with self.assertNumQueries(2):
+            self.assertEqual(store.getAssociation(url).handle, 'newer')
+        with self.assertNumQueries(2):
+            self.assertEqual(store.getAssociation(url, 'new').handle, 'new')
+        self.assertEqual(OpenIDAssociation.objects.filter(handle__startswith='old').count(), 0)
+        with self.assertNumQueries(1):
+            self.assertTrue(store.removeAssociation(url, 'new'))
+        self.assertFalse(store.removeAssociation(url, 'new'))
+        self.assertEqual(store.getAssociation(url, 'new'), None)
+
+    def test_association_cached(self):
+        store = DjangoOpenIDStore()
+        url = 'https://example.com/'
+        stamp = int(time.time())
+        store.storeAssociation(url, Association('handle', 'secret', stamp, 100, 'HMAC-SHA1'))
+        self.assertEqual(store.getAssociation(url).handle, 'handle')
+        with self.assertNumQueries(0):
+            self.assertEqual(store.getAssociation(url).secret, 'secret')
+        store.storeAssociation(url, Association('handle', 'secret2', stamp, 100, 'HMAC-SHA1'))
+        self.assertEqual(DjangoOpenIDStore().getAssociation(url).secret, 'secret2')
+        store.removeAssociation(url, 'handle')
+        self.assertEqual(DjangoOpenIDStore().getAssociation(url), None)
+
+    def test_backend_from_settings(self):
+        alias = 'django.core.cache.backends.locmem.LocMemCache'
+        with override_settings(CEL_OPENID_ASSOCIATION_CACHE=alias):
+            backend = association_cache._shared()
+            self.assertIs(association_cache._shared(), backend)
+            other = []
+            thread = threading.Thread(target=lambda: other.append(association_cache._shared()))
+            thread.start()
+            thread.join()
+            self.assertIsNot(other[0], backend)
+            self.assertTrue(backend is not None and other[0] is not None)
+        self.assertIsNone(association_cache._shared())
+
+    def test_association_removal_shared(self):
+        backend = get_cache('django.core.cache.backends.locmem.LocMemCache',
+                            LOCATION='celauth-tests')
+        backend.clear()
+        # stores of two processes sharing one cache backend
+        store = DjangoOpenIDStore(AssociationCache(backend=backend))
+        other = DjangoOpenIDStore(AssociationCache(backend=backend))
+        url = 'https://example.com/'
+        stamp = int(time.time())
+        store.storeAssociation(url, Association('handle', 'secret', stamp, 100, 'HMAC-SHA1'))
+        self.assertEqual(other.getAssociation(url).handle, 'handle')
+        with self.assertNumQueries(0):
+            self.assertEqual(other.getAssociation(url).handle, 'handle')
+        store.removeAssociation(url, 'handle')
+        self.assertEqual(other.getAssociation(url), None)
+
+XRDS = """<?xml version="1.0" encoding="UTF-8"?>
+<xrds:XRDS xmlns:xrds="xri://$xrds" xmlns="xri://$xrd*($v*2.0)">
+  <XRD>
+    <Service priority="0">
+      <Type>http://specs.openid.net/auth/2.0/server</Type>
+      <URI>https://example.com/server</URI>
+    </Service>
+  </XRD>
+</xrds:XRDS>
+"""
+
+class StubFetcher(fetchers.HTTPFetcher):
+    def __init__(self, docs):
+        self.docs = docs
+        self.fetched = []
+
+    def fetch(self, url, body=None, headers=None):
+        self.fetched.append(url)
+        if url in self.docs:
+            headers = {'content-type': 'application/xrds+xml'}
+            return fetchers.HTTPResponse(url, 200, headers, self.docs[url])
+        return fetchers.HTTPResponse(url, 404, {}, '')
+
+class OpenIDChoicesTest(TestCase):
+    def test_lookups(self):
+        choices = providers.OpenIDChoices([
+            ('google', 'Google', 'https://www.google.com/accounts/o8/id'),
+            ('yahoo', 'Yahoo!', 'https://me.yahoo.com/'),
+        ])
+        self.assertIs(choices.choices('login-'), choices.choices('login-'))
+        self.assertEqual(choices.choices('login-'),
+                         (('login-google', 'Google'), ('login-yahoo', 'Yahoo!')))
+        post = {'next': '/there', 'login-yahoo': 'Yahoo!'}
+        self.assertEqual(choices.chosen_url(post, 'login-'), 'https://me.yahoo.com/')
+        self.assertEqual(choices.chosen_url({'login': 'Log in'}, 'login-'), None)
+        more = choices.extended([('yahoo', 'Yahoo', 'https://yahoo.com/'),
+                                 ('example', 'Example', 'https://example.com/')])
+        self.assertEqual(more.ids(), ['google', 'yahoo', 'example'])
+        self.assertEqual(more.chosen_url(['example'], ''), 'https://example.com/')
+        self.assertEqual(choices.ids(), ['google', 'yahoo'])
+
+    @override_settings(CEL_OPENID_PROVIDERS=[('example', 'Example', 'https://example.com/joe')])
+    def test_custom_provider(self):
+        response = self.client.get(reverse('celauth:login'), HTTP_HOST='testserver')
+        self.assertContains(response, 'login-example')
+        response = self.client.post(reverse('celauth:login'), {'login-example': 'Example'},
+                                    HTTP_HOST='testserver')
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(reverse('celauth:login_return'), response['Location'])
+
+class ProviderButtonsTest(TestCase):
+    def test_rendered_once(self):
+        choices = providers.OPENID_PROVIDERS.choices('login-')
+        html = provider_buttons_html(choices, True)
+        self.assertIs(provider_buttons_html(list(choices), True), html)
+        self.assertIn('name="login-yahoo"', html)
+        self.assertIn('Any OpenID', html)
+        self.assertNotIn('Any OpenID', provider_buttons_html(choices, False))
+        with self.settings(TEMPLATE_DEBUG=True):
+            self.assertIsNot(provider_buttons_html(choices, True), html)
+        response = self.client.get(reverse('celauth:login'), HTTP_HOST='testserver')
+        self.assertContains(response, 'name="login-yahoo"')
+
+class DiscoveryCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.real_fetcher = fetchers.getDefaultFetcher()
+        self.fetcher = StubFetcher({'https://example.com/': XRDS})
+        fetchers.setDefaultFetcher(self.fetcher, wrap_exceptions=False)
+
+    def tearDown(self):
+        fetchers.setDefaultFetcher(self.real_fetcher)
+
+    def test_discovery_cached(self):
+        cache = providers.DiscoveryCache()
+        claimed_id, services = cache.discover('https://example.com/')
+        self.assertEqual(services[0].server_url, 'https://example.com/server')
+        claimed_id, services = cache.discover(' https://EXAMPLE.com/ ')
+        self.assertEqual(services[0].server_url, 'https://example.com/server')
+        self.assertEqual(len(self.fetcher.fetched), 1)
+        self.assertRaises(DiscoveryFailure, cache.discover, 'https://example.org/')
+        self.assertRaises(DiscoveryFailure, cache.discover, 'https://example.org/')
+        self.assertEqual(len(self.fetcher.fetched), 2)
+
+class MailerTest(TestCase):
+    def test_precompiled_message(self):
+        request = RequestFactory().get('/', HTTP_HOST='testserver')
+        mailer = Mailer(request, 'celauth:confirm_email', delivery=object())
+        for code in ['ABCD2345', 'EFGH6789']:
+            message = mailer.message(code, 'joe@example.com')
+            expected = _message_uncached(mailer, code, 'joe@example.com')
+            self.assertEqual((message.subject, message.body), expected)
+            self.assertIn('/confirm_email/' + code, message.body)
+        timing = time_mailer(10)
+        self.assertTrue(timing['render_to_string'] > 0 and timing['precompiled'] > 0)
+
+class FailingEmailBackend(BaseEmailBackend):
+    def send_messages(self, email_messages):
+        raise IOError("SMTP unavailable")
+
+class FlakyEmailBackend(locmem.EmailBackend):
+    failures = 0
+
+    def send_messages(self, email_messages):
+        if FlakyEmailBackend.failures:
+            FlakyEmailBackend.failures -= 1
+            raise IOError("SMTP unavailable")
+        return super(FlakyEmailBackend, self).send_messages(email_messages)
+
+class FlakyMessage(object):
+    failures = 1
+
+    def send(self):
+        if self.failures:
+            self.failures -= 1
+            raise IOError("SMTP unavailable")
+        mail.outbox.append(self)
+
+class DeliveryTest(TestCase):
+    def message(self, address='joe@example.com'):
+        return EmailMessage('Confirmation Code', 'CODE', 'noreply@example.com', [address])
+
+    def test_thread_pool(self):
+        delivery = ThreadPoolDelivery(backoff_seconds=0.1)
+        delivery.deliver(FlakyMessage(), ('joe@example.com', 'CODE'))
+        delivery.deliver(self.message(), ('joe@example.com', 'CODE'))
+        delivery.deliver(self.message('me@example.com'), ('me@example.com', 'CODE'))
+        delivery.join()
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_thread_pool_full(self):
+        delivery = ThreadPoolDelivery(workers=0, max_queued=1, backoff_seconds=60)
+        delivery.deliver(self.message(), ('joe@example.com', 'CODE'))
+        start = time.time()
+        delivery.deliver(FlakyMessage(), ('me@example.com', 'CODE'))
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_batching(self):
+        delivery = BatchingDelivery(max_batch=2, max_wait=60)
+        delivery.deliver(self.message(), ('joe@example.com', 'CODE'))
+        delivery.deliver(self.message(), ('joe@example.com', 'CODE'))
+        self.assertEqual(len(mail.outbox), 0)
+        delivery.deliver(self.message('me@example.com'), ('me@example.com', 'CODE'))
+        self.assertEqual(len(mail.outbox), 2)
+        delivery.deliver(self.message('you@example.com'), ('you@example.com', 'CODE'))
+        delivery.flush()
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual([(b.size, b.sent) for b in delivery.batches], [(2, 2), (1, 1)])
+
+    @override_settings(EMAIL_BACKEND='celauth.dj.celauth.tests.FlakyEmailBackend')
+    def test_batching_retries(self):
+        FlakyEmailBackend.failures = 1
+        delivery = BatchingDelivery(max_batch=2, max_wait=60, backoff_seconds=60)
+        delivery.deliver(self.message(), ('joe@example.com', 'CODE'))
+        delivery.deliver(self.message('me@example.com'), ('me@example.com', 'CODE'))
+        self.assertEqual([m.to for m in mail.outbox], [['me@example.com']])
+        delivery.flush()
+        self.assertEqual([m.to for m in mail.outbox], [['me@example.com'], ['joe@example.com']])
+        self.assertEqual([(b.size, b.sent) for b in delivery.batches], [(2, 1), (1, 1)])
+
+    @override_settings(EMAIL_BACKEND='celauth.dj.celauth.tests.FailingEmailBackend')
+    def test_batching_gives_up(self):
+        delivery = BatchingDelivery(max_wait=60, max_attempts=2, backoff_seconds=60)
+        delivery.deliver(self.message(), ('joe@example.com', 'CODE'))
+        for i in range(3):
+            delivery.flush()
+        self.assertEqual([(b.size, b.sent) for b in delivery.batches], [(1, 0), (1, 0)])
+
+    def test_outbox(self):
+        delivery = OutboxDelivery()
+        delivery.deliver(self.message(), ('joe@example.com', 'CODE'))
+        delivery.deliver(self.message(), ('joe@example.com', 'CODE'))
+        self.assertEqual(OutboxEmail.objects.count(), 1)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(drain_outbox(), (1, 0))
+        self.assertEqual(mail.outbox[0].to, ['joe@example.com'])
+        self.assertEqual(OutboxEmail.objects.count(), 0)
+
+    @override_settings(EMAIL_BACKEND='celauth.dj.celauth.tests.FailingEmailBackend')
+    def test_outbox_gives_up(self):
+        OutboxDelivery().deliver(self.message(), ('joe@example.com', 'CODE'))
+        for attempts in range(1, 3):
+            self.assertEqual(drain_outbox(max_attempts=2), (0, 1))
+            self.assertEqual(OutboxEmail.objects.filter(attempts=attempts).count(), 2 - attempts)
+            OutboxEmail.objects.update(next_attempt=datetime.utcnow())
+        self.assertEqual(drain_outbox(max_attempts=2), (0, 0))
+
+class BucketStoreTest(TestCase):
+    def test_bucket_stores(self):
+        cache = get_cache('django.core.cache.backends.locmem.LocMemCache',
+                          LOCATION='celauth-tests')
+        cache.clear()
+        for store in [ModelBucketStore(), CacheBucketStore(cache)]:
+            buckets = TokenBuckets(store, capacity=1, refill_seconds=60)
+            self.assertTrue(buckets.take(['address:joe@example.com', 'login:joe'], now=0))
+            self.assertFalse(buckets.take(['address:joe@example.com'], now=30))
+            self.assertTrue(buckets.take(['address:joe@example.com'], now=90))
+            # tokens taken are given back when a later bucket is empty
+            self.assertFalse(buckets.take(['login:jim', 'address:joe@example.com'], now=100))
+            self.assertTrue(buckets.take(['login:jim'], now=100))
+
+    def test_concurrent_cache_takes(self):
+        cache = get_cache('django.core.cache.backends.locmem.LocMemCache',
+                          LOCATION='celauth-tests')
+        cache.clear()
+        buckets = TokenBuckets(CacheBucketStore(cache), capacity=3, refill_seconds=60)
+        start = threading.Event()
+        taken = []
+        def take():
+            start.wait()
+            taken.append(buckets.take(['address:joe@example.com'], now=0))
+        threads = [threading.Thread(target=take) for i in range(8)]
+        for t in threads:
+            t.start()
+        start.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(3, taken.count(True))
+
+    def test_model_take_is_one_update(self):
+        buckets = TokenBuckets(ModelBucketStore(), capacity=2, refill_seconds=60)
+        buckets.take(['address:joe@example.com'], now=0)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(buckets.take(['address:joe@example.com'], now=0))
+            self.assertFalse(buckets.take(['address:joe@example.com'], now=0))
+        # a take that finds no token tries to make the bucket, failing
+        updates = [q['sql'] for q in queries.captured_queries if 'UPDATE' in q['sql']]
+        self.assertEqual(3, len(updates))
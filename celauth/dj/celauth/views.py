@@ -5,27 +5,72 @@ from django.views.decorators.http import require_http_methods
 from django.core.urlresolvers import reverse
 from django.utils.module_loading import import_by_path
 from django.http import HttpResponse, HttpResponseRedirect
+from django.test.signals import setting_changed
+import threading
 import urllib
 from django import forms
 from openid.consumer.discover import DiscoveryFailure
 from celauth import OpenIDCase
 from celauth.session import CelSession
 from celauth.core import make_auth_gate, InvalidConfirmationCode, AddressAccountConflict
-from celauth.providers import OPENID_PROVIDERS, facade
+from celauth.core import TooManyConfirmationCodes
+from celauth.providers import openid_providers, facade
 from celauth.dj.celauth import Mailer
 from celauth.dj.celauth.models import DjangoCelModelStore
+from celauth.dj.celauth.cache import CachedCelRegistryStore, registry_cache
+from celauth.dj.celauth.ratelimit import code_limiter
+from celauth.dj.celauth.codes import signed_codes
 
 REDIRECT_FIELD_NAME = 'next'
 LOGIN_BUTTON_NAME = 'login'
 assert REDIRECT_FIELD_NAME != LOGIN_BUTTON_NAME
 
 
+class AuthGateFactory(object):
+    """Makes AuthGates from settings resolved once per process.
+
+    Cache backends, used by the registry store cache, rate limit and signed
+    codes, are not all thread-safe, so those are set up once per thread.
+    """
+
+    def __init__(self):
+        self.AccountManager = import_by_path(settings.CEL_ACCOUNTANT)
+        self.SessionStore = import_by_path(settings.CEL_SESSION_STORE)
+        self._local = threading.local()
+
+    def _per_thread(self):
+        if not hasattr(self._local, 'code_limiter'):
+            self._local.registry_cache = registry_cache()
+            self._local.code_limiter = code_limiter()
+            self._local.signed_codes = signed_codes()
+        return self._local
+
+    def __call__(self, request):
+        local = self._per_thread()
+        mailer = Mailer(request, 'celauth:confirm_email')
+        registry_store = DjangoCelModelStore(self.AccountManager())
+        if local.registry_cache is not None:
+            registry_store = CachedCelRegistryStore(registry_store, local.registry_cache)
+        return make_auth_gate(registry_store, mailer, self.SessionStore(request),
+                              local.code_limiter, local.signed_codes)
+
+_gate_factory = None
+
+def _reset_gate_factory(**kwargs):
+    global _gate_factory
+    _gate_factory = None
+
+setting_changed.connect(_reset_gate_factory)
+
 def get_auth_gate(request):
-    AccountManager = import_by_path(settings.CEL_ACCOUNTANT)
-    mailer = Mailer(request, 'celauth:confirm_email')
-    registry_store = DjangoCelModelStore(AccountManager())
-    SessionStore = import_by_path(settings.CEL_SESSION_STORE)
-    return make_auth_gate(registry_store, mailer, SessionStore(request))
+    """AuthGate of request, made once per request"""
+    global _gate_factory
+    gate = getattr(request, '_cel_auth_gate', None)
+    if gate is None:
+        if _gate_factory is None:
+            _gate_factory = AuthGateFactory()
+        gate = request._cel_auth_gate = _gate_factory(request)
+    return gate
 
 
 @require_http_methods(["GET", "POST"])
@@ -73,17 +118,15 @@ class OpenIDLoginForm(forms.Form):
     )
 
 def provider_buttons_iteritems():
-    button_names = OPENID_PROVIDERS.ids(LOGIN_BUTTON_NAME + '-')
-    return zip(button_names, OPENID_PROVIDERS.texts())
+    return openid_providers().choices(LOGIN_BUTTON_NAME + '-')
 
 def choose_openid_response(request, gate):
     final_url = request.REQUEST.get(REDIRECT_FIELD_NAME, None)
     openid_form = None
     if request.method == 'POST':
-        button_urls = OPENID_PROVIDERS.urls_by_id(LOGIN_BUTTON_NAME + '-')
-        for button_name, openid_url in button_urls.iteritems():
-          if button_name in request.POST:
-              return initial_response(request, openid_url, final_url)
+        openid_url = openid_providers().chosen_url(request.POST, LOGIN_BUTTON_NAME + '-')
+        if openid_url:
+            return initial_response(request, openid_url, final_url)
 
         if LOGIN_BUTTON_NAME in request.POST:
             # OpenID field should have been filled
@@ -171,7 +214,10 @@ def enter_address_response(request, gate, post_data = None):
         }
         return render(request, 'celauth/enter_address.html', vals)
 
-    gate.claim(form.cleaned_data['address'])
+    try:
+        gate.claim(form.cleaned_data['address'])
+    except TooManyConfirmationCodes as ex:
+        return failure(request, ex.msg, status=429)
     return enter_code_response(request, gate, check_email_msg=True)
 
 @require_http_methods(["GET", "POST"])
@@ -220,7 +266,7 @@ def logout(request):
     return default_view(request)
 
 
-def failure(request, message, exception=None):
+def failure(request, message, exception=None, status=403):
     gate = get_auth_gate(request)
     vals = {
         'gate': gate,
@@ -228,5 +274,5 @@ def failure(request, message, exception=None):
     }
     if settings.DEBUG and exception:
         vals['exception'] = str(exception)
-    return render(request, 'celauth/failure.html', vals, status=403)
+    return render(request, 'celauth/failure.html', vals, status=status)
 
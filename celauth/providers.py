@@ -1,20 +1,59 @@
 
+import threading
+import time
 import urlparse
+from collections import OrderedDict
+from django.conf import settings
+from django.test.signals import setting_changed
+from openid import fetchers
 from openid.consumer import consumer
+from openid.consumer.discover import discover, normalizeURL, normalizeXRI, DiscoveryFailure
 from openid.extensions import sreg, ax
+from openid.yadis import xri
 from celauth import OpenIDCase
 from celauth.dj.celauth.openid_store import DjangoOpenIDStore
 
 class OpenIDChoices(object):
+    """Immutable choices of OpenID providers, given as (id, text, url) triples.
+    Lookup tables are computed once.
+    """
+
     def __init__(self, data):
-        self.data = data
+        self.data = tuple(tuple(x) for x in data)
+        self._urls = dict((x[0], x[2]) for x in self.data)
+        self._choices = dict() # id prefix -> ((prefixed id, text), ...)
+
     def ids(self, id_prefix=''):
         return [id_prefix + x[0] for x in self.data]
+
     def texts(self):
         return [x[1] for x in self.data]
+
     def urls_by_id(self, id_prefix=''):
         return dict( (id_prefix + x[0], x[2]) for x in self.data )
 
+    def choices(self, id_prefix=''):
+        """Tuple of (prefixed id, text) pairs"""
+        ret = self._choices.get(id_prefix)
+        if ret is None:
+            ret = tuple((id_prefix + x[0], x[1]) for x in self.data)
+            ret = self._choices.setdefault(id_prefix, ret)
+        return ret
+
+    def chosen_url(self, keys, id_prefix=''):
+        """URL of the provider whose prefixed id is among keys, otherwise None"""
+        for key in keys:
+            if key.startswith(id_prefix):
+                url = self._urls.get(key[len(id_prefix):])
+                if url:
+                    return url
+        return None
+
+    def extended(self, data):
+        """New choices with (id, text, url) triples added, replacing those of same id"""
+        ids = set(x[0] for x in data)
+        return OpenIDChoices([x for x in self.data if x[0] not in ids] + list(data))
+
 OPENID_PROVIDERS = OpenIDChoices([
   ('google',        'Google',        'https://www.google.com/accounts/o8/id'),
   ('yahoo',         'Yahoo!',        'https://me.yahoo.com/'),
@@ -24,6 +63,93 @@ OPENID_PROVIDERS = OpenIDChoices([
   ('intuit',        'Intuit',        'https://openid.intuit.com/openid/xrds'),
 ])
 
+_openid_providers = None
+
+def openid_providers():
+    """OPENID_PROVIDERS extended by settings.CEL_OPENID_PROVIDERS, a list of
+    (id, text, url) triples
+    """
+    global _openid_providers
+    if _openid_providers is None:
+        extra = getattr(settings, 'CEL_OPENID_PROVIDERS', ())
+        _openid_providers = OPENID_PROVIDERS.extended(extra) if extra else OPENID_PROVIDERS
+    return _openid_providers
+
+def _reset_openid_providers(setting, **kwargs):
+    global _openid_providers
+    if setting == 'CEL_OPENID_PROVIDERS':
+        _openid_providers = None
+
+setting_changed.connect(_reset_openid_providers)
+
+class DiscoveryCache(object):
+    """Thread-safe LRU cache of OpenID discovery results by normalized identifier.
+
+    Discovery failures are cached too, for the shorter failure_ttl seconds.
+    """
+
+    def __init__(self, ttl=60*60, failure_ttl=60, max_size=256, discover=discover):
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.max_size = max_size
+        self._discover = discover
+        self._entries = OrderedDict() # key -> (expiration time, result, failure)
+        self._lock = threading.Lock()
+
+    def _normalize(self, identifier):
+        identifier = identifier.strip()
+        if xri.identifierScheme(identifier) == "XRI":
+            return normalizeXRI(identifier)
+        if not urlparse.urlparse(identifier)[0]:
+            identifier = 'http://' + identifier
+        return normalizeURL(identifier)
+
+    def discover(self, identifier):
+        """Same as openid.consumer.discover.discover but cached"""
+        key = self._normalize(identifier)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry and entry[0] > now:
+                self._entries[key] = entry
+            else:
+                entry = None
+        if entry:
+            expiration, result, failure = entry
+            if failure:
+                raise failure
+            return result[0], list(result[1])
+        try:
+            result = self._discover(identifier)
+        except (DiscoveryFailure, fetchers.HTTPFetchingError), ex:
+            self._put(key, (now + self.failure_ttl, None, ex))
+            raise
+        self._put(key, (now + self.ttl, result, None))
+        return result[0], list(result[1])
+
+    def _put(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def warm(self, identifiers):
+        for identifier in identifiers:
+            try:
+                self.discover(identifier)
+            except (DiscoveryFailure, fetchers.HTTPFetchingError):
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+discovery_cache = DiscoveryCache()
+
+def warm_discovery_cache():
+    discovery_cache.warm(openid_providers().urls_by_id().values())
+
 class TestOpenIDHelper:
     def __init__(self, real):
         self.case = None
@@ -56,7 +182,9 @@ class LiveOpenIDHelper:
 
     def _openid_consumer(self, request):
         openid_store = DjangoOpenIDStore()
-        return consumer.Consumer(request.session, openid_store)
+        oc = consumer.Consumer(request.session, openid_store)
+        oc._discover = discovery_cache.discover
+        return oc
 
     def initial_response(self, request, user_url, return_url):
         oc = self._openid_consumer(request)
@@ -14,10 +14,20 @@ class CelSession(object):
         self._store.vals['loginid'] = value
         self._store.update()
 
+    @property
+    def account(self):
+        """Get the account of the current loginid, as of the last update"""
+        return self._store.vals.get('account', None)
+
+    @account.setter
+    def account(self, value):
+        """Set the account of the current loginid, saved by the next update"""
+        self._store.vals['account'] = value
+
     def clear(self):
         """Clear all session authentication state"""
+        self.account = None
         self.loginid = None
-        self._store.update()
 
     def account_update(self):
         self._store.update()
@@ -4,12 +4,16 @@
 formalization of the Claimed Email Login model.
 """
 
+import time
+from contextlib import contextmanager
+
 # django.utils.unittest is Python 2.7 unittest backported
 # django.utils.unittest used while Python 2.6 supported
 # use unittest2 to remove Django dependency on Python 2.6 
 from django.utils import unittest
 
-from celauth.core import make_auth_gate
+from celauth.core import make_auth_gate, TokenBuckets, TooManyConfirmationCodes
+from celauth.core import SignedCodes, InvalidConfirmationCode
 from celauth.session import CelSession
 from celauth import OpenIDCase
 
@@ -18,6 +22,7 @@ class TestSessionStore(object):
     """
     def __init__(self, request=None):
         self._vals = dict()
+        self.updates = 0
 
     @property
     def vals(self):
@@ -27,7 +32,7 @@ class TestSessionStore(object):
         """Let implementation follow up with database updates, login/logouts, etc...
         for any changes made to self.loginids
         """
-        pass
+        self.updates += 1
 
 class TestCelLoginStore(object):
     """ View into CEL store state per login
@@ -60,6 +65,7 @@ class TestCelRegistryStore(object):
         self.loginid2account = dict()
         self.address2account = dict()
         self.code2address = dict()
+        self.code2time = dict()
         
         self.claims = dict()
         """Mapping from loginids to addresses"""
@@ -83,6 +89,10 @@ class TestCelRegistryStore(object):
         lids = self.loginids
         return [l for l, a in self.loginid2account.items() if a == account]
 
+    def account_logins(self, account):
+        return [(l, self.claims.get(l, None), l in self.confirms)
+                for l in self.loginids(account)]
+
     def get_login(self, loginid):
         assert loginid
         return TestCelLoginStore(self, loginid)
@@ -97,6 +107,16 @@ class TestCelRegistryStore(object):
         assert self.is_free_address(address)
         self.address2account[address] = account
 
+    def login_key(self, loginid):
+        return loginid
+
+    def login_by_key(self, key):
+        return key
+
+    @contextmanager
+    def atomic(self):
+        yield
+
     def note_openid(self, openid_case):
         loginid = openid_case.claimed_id
         self.loginid2account.setdefault(loginid, None)
@@ -112,6 +132,14 @@ class TestCelRegistryStore(object):
     def save_confirmation_code(self, code, address):
         assert code not in self.code2address
         self.code2address[code] = address
+        self.code2time[code] = time.time()
+
+    def recent_code(self, address, seconds):
+        since = time.time() - seconds
+        for c, a in self.code2address.items():
+            if a == address and self.code2time[c] > since:
+                return c
+        return None
 
     def confirm_email(self, loginid, code):
         address = self.code2address.get(code, None)
@@ -120,6 +148,13 @@ class TestCelRegistryStore(object):
             self.confirms.add(loginid)
         return address
 
+    def confirm_address(self, loginid, address):
+        if self.claims.get(loginid, address) != address:
+            return None
+        self.claims[loginid] = address
+        self.confirms.add(loginid)
+        return address
+
     def assigned_account(self, address):
         account = self.address2account.get(address, None)
         if account and account in self.loginid2account.values():
@@ -145,6 +180,26 @@ class TestCelRegistryStore(object):
             self.loginid2account[loginid] = account_num
         return account_num
 
+class TestBucketStore(dict):
+    def take(self, key, capacity, refill_seconds, now):
+        tokens, stamp = self.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - stamp) / refill_seconds)
+        if tokens < 1:
+            return False
+        self[key] = (tokens - 1, now)
+        return True
+
+    def give(self, key, capacity, refill_seconds, now):
+        tokens, stamp = self[key]
+        self[key] = (tokens + 1, stamp)
+
+class TestReplaySet(dict):
+    def add(self, code, expiration):
+        if code in self:
+            return False
+        self[code] = expiration
+        return True
+
 class FakeMailer(object):
     last_code = None
 
@@ -239,6 +294,39 @@ class CelTestCase(unittest.TestCase):
             ]),
                         ]))
 
+    def test_account_logins(self):
+        self.new_account(openid('com', 'me'))
+        self.gate.logout()
+        self.login_as(openid('com', 'me2', 'me@example.com'))
+        self.assertEqual(self.gate.addresses_pending(), ['me@example.com'])
+        self.assertEqual(self.gate.addresses_confirmed(), [])
+        self.login_as(openid('com', 'me'))
+        logins = self.store.account_logins(self.gate.account)
+        self.assertEqual(sorted((a, c) for l, a, c in logins), [
+            ('me@example.com', False),
+            ('me@example.com', True),
+        ])
+        self.assertEqual(self.gate.addresses(), ['me@example.com'])
+        self.assertEqual(self.gate.addresses_confirmed(), ['me@example.com'])
+        take_code_from_email()
+
+    def test_login_lookups_memoized(self):
+        self.new_account(openid('com', 'joe'))
+        looked_up = []
+        get_login = self.store.get_login
+        def counting_get_login(loginid):
+            looked_up.append(loginid)
+            return get_login(loginid)
+        self.store.get_login = counting_get_login
+        for i in range(2):
+            self.assertTrue(self.gate.account)
+            self.assertFalse(self.gate.must_join_account())
+            self.assertFalse(self.gate.confirmation_required())
+            self.assertFalse(self.gate.can_create_account())
+        self.assertLessEqual(len(looked_up), 1)
+        self.gate.logout()
+        self.assertFalse(self.gate.account)
+
     def test_anon_address_entry(self):
         self.assertFalse(code_in_email())
         self.gate.claim('me@example.com')
@@ -254,6 +342,93 @@ class FakeStoreTestCase(CelTestCase):
         self.store = None
         self.gate = None
 
+class CodeRateLimitTestCase(unittest.TestCase):
+    def test_token_buckets(self):
+        buckets = TokenBuckets(TestBucketStore(), capacity=2, refill_seconds=10)
+        self.assertTrue(buckets.take(['a'], now=100))
+        self.assertTrue(buckets.take(['a', 'b'], now=100))
+        self.assertFalse(buckets.take(['a', 'b'], now=100))
+        self.assertTrue(buckets.take(['b'], now=100))
+        self.assertTrue(buckets.take(['a'], now=110))
+        self.assertFalse(buckets.take(['a'], now=110))
+
+    def test_claims_limited(self):
+        store = TestCelRegistryStore()
+        limiter = TokenBuckets(TestBucketStore(), capacity=2, refill_seconds=60)
+        gate = make_auth_gate(store, FakeMailer(), TestSessionStore(), limiter)
+        gate.claim('me@example.com')
+        code = take_code_from_email()
+        gate.claim('me@example.com')
+        self.assertEqual(take_code_from_email(), code) # code already sent is still valid
+        self.assertRaises(TooManyConfirmationCodes, gate.claim, 'me@example.com')
+        self.assertFalse(code_in_email())
+
+    def test_recent_code_sent_again(self):
+        store = TestCelRegistryStore()
+        gate = make_auth_gate(store, FakeMailer(), TestSessionStore())
+        gate.claim('me@example.com')
+        code = take_code_from_email()
+        gate.claim('me@example.com')
+        self.assertEqual(take_code_from_email(), code)
+        for c in store.code2time:
+            store.code2time[c] -= 60 * 60
+        gate.claim('me@example.com')
+        self.assertNotEqual(take_code_from_email(), code)
+
+class SessionTestCase(unittest.TestCase):
+    def test_clear_updates_once(self):
+        store = TestSessionStore()
+        session = CelSession(store)
+        session.loginid = 'https://example.com/joe'
+        session.clear()
+        self.assertEqual(session.loginid, None)
+        self.assertEqual(store.updates, 2)
+
+class SignedCodesStoreTestCase(CelTestCase):
+    def setUp(self):
+        self.store = TestCelRegistryStore()
+        signed_codes = SignedCodes('secret', TestReplaySet())
+        self.gate = make_auth_gate(self.store, FakeMailer(), TestSessionStore(),
+                                   signed_codes=signed_codes)
+
+    def tearDown(self):
+        self.store = None
+        self.gate = None
+
+    def test_no_codes_stored(self):
+        self.gate.claim('me@example.com')
+        self.assertTrue(take_code_from_email())
+        self.assertEqual(self.store.code2address, {})
+
+    def test_code_not_used_by_other_address(self):
+        self.gate.login(openid('com', 'joe'))
+        self.gate.claim('joe@example.com')
+        code = take_code_from_email()
+        self.gate.logout()
+        self.gate.login(openid('org', 'sue', 'sue@example.com'))
+        self.assertRaises(InvalidConfirmationCode, self.gate.confirm_email, code)
+        self.gate.logout()
+        self.gate.login(openid('com', 'joe'))
+        self.gate.confirm_email(code)
+        self.assertEqual(self.gate.addresses_confirmed(), ['joe@example.com'])
+
+class SignedCodesTestCase(unittest.TestCase):
+    def test_check(self):
+        codes = SignedCodes('secret', TestReplaySet(), lifetime=60)
+        code = codes.make('me@example.com', now=100)
+        self.assertTrue(code.isalnum())
+        self.assertEqual(codes.check(code, now=160), 'me@example.com')
+        self.assertEqual(codes.check(code, now=160), None) # used already
+        self.assertEqual(codes.verify(code, now=160), 'me@example.com')
+        self.assertFalse(codes.use(code))
+        code = codes.make('me@example.com', now=101)
+        self.assertEqual(codes.check(code, now=162), None) # expired
+        self.assertEqual(codes.check(code.lower(), now=101), 'me@example.com')
+        other = SignedCodes('other secret', TestReplaySet())
+        self.assertEqual(other.check(codes.make('me@example.com')), None)
+        self.assertEqual(codes.check(u'NOT A CODE'), None)
+        self.assertEqual(codes.check(u'\xe9'), None)
+
 if __name__ == '__main__':
     unittest.main()
 
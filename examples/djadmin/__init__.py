@@ -24,6 +24,18 @@ class DjangoUserManager():
             #TODO raise exception if multiple users
             return users[0].id if len(users) == 1 else None
 
+    def assigned_accounts(self, email_addresses):
+        """Same as assigned_account for many addresses, as dict of address to account"""
+        UserModel = django.contrib.auth.get_user_model()
+        active = UserModel.objects.filter(is_active=True)
+        by_email = dict()
+        for user_id, email in active.filter(email__in=email_addresses).values_list('id', 'email'):
+            by_email.setdefault(email, []).append(user_id)
+        ret = dict((email, ids[0]) for email, ids in by_email.items() if len(ids) == 1)
+        ret.update(dict((username, user_id) for user_id, username in
+                        active.filter(username__in=email_addresses).values_list('id', 'username')))
+        return ret
+
     def create_account(self, email_address):
         assert email_address
         UserModel = django.contrib.auth.get_user_model()
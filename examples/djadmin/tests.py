@@ -2,6 +2,7 @@ from django.utils import unittest
 from django.test import TestCase
 from django.contrib.auth import get_user_model
 from django.core import mail
+from djadmin import DjangoUserManager
 
 class DjadminTest(TestCase):
     def get_confirmation_code(self):
@@ -41,3 +42,17 @@ class DjadminTest(TestCase):
         response = self.client.post("/openid/confirm_email/", data, follow=True, HTTP_HOST='testserver')
         self.assertContains(response, "Site administration")
 
+
+    def test_assigned_accounts(self):
+        UserModel = get_user_model()
+        UserModel.objects.create_user('joe@example.com', 'joe@example.com')
+        UserModel.objects.create_user('jim', 'jim@example.com')
+        UserModel.objects.create_user('ann', 'twins@example.com')
+        UserModel.objects.create_user('eve', 'twins@example.com')
+        accountant = DjangoUserManager()
+        addresses = ['joe@example.com', 'jim@example.com', 'twins@example.com',
+                     'nobody@example.com']
+        expected = dict((a, accountant.assigned_account(a)) for a in addresses)
+        expected = dict((a, account) for a, account in expected.items() if account)
+        self.assertEqual(len(expected), 2)
+        self.assertEqual(accountant.assigned_accounts(addresses), expected)
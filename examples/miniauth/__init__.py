@@ -4,6 +4,9 @@ class Accountant(object):
     def assigned_account(self, email_address):
         return None
 
+    def assigned_accounts(self, email_addresses):
+        return dict()
+
     def create_account(self, email_address):
         account = Account.objects.create()
         return account.id
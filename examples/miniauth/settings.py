@@ -89,3 +89,13 @@ CONFIRM_EMAIL_FROM = 'noreply@example.com'
 
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
+# maximum queries per login flow step of celauth.dj.celauth.benchmarks
+CEL_BENCHMARK_MAX_QUERIES = {
+    'login_page': 3,
+    'login': 1,
+    'login_return': 4,
+    'enter_address': 6,
+    'confirm_email': 8,
+    'create_account': 9,
+    'logout': 2,
+}
@@ -14,7 +14,10 @@ setup(name='django-openid-celauth',
       packages=['celauth',
                 'celauth.dj',
                 'celauth.dj.celauth',
+                'celauth.dj.celauth.management',
+                'celauth.dj.celauth.management.commands',
                 'celauth.dj.celauth.migrations',
+                'celauth.dj.celauth.templatetags',
                ],
       package_data={'celauth.dj.celauth': ['templates/celauth/*']},
       classifiers=['Development Status :: 2 - Pre-Alpha',